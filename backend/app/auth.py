@@ -1,16 +1,34 @@
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Dict, Iterable, Optional, Tuple
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from fastapi import HTTPException, status, Depends
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+import base64
+import hashlib
+import hmac
+import logging
 import os
+import secrets
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
 
 # JWT 設定
 SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key-change-in-production")
 ALGORITHM = "HS256"
-ACCESS_TOKEN_EXPIRE_MINUTES = 30
+ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "30"))
+REFRESH_TOKEN_EXPIRE_DAYS = int(os.getenv("REFRESH_TOKEN_EXPIRE_DAYS", "14"))
+# 已使用的 refresh token 在這段時間內再次出現時，視為多個分頁同時換發，回傳同一個新 token 而不撤銷
+REFRESH_TOKEN_REUSE_GRACE_SECONDS = float(os.getenv("REFRESH_TOKEN_REUSE_GRACE_SECONDS", "30"))
+
+# 使用者資料快取時間（秒）：刪除使用者後最多經過這段時間，其 token 即失效
+USER_CACHE_TTL_SECONDS = float(os.getenv("USER_CACHE_TTL_SECONDS", "60"))
+USER_CACHE_MAX_SIZE = int(os.getenv("USER_CACHE_MAX_SIZE", "10000"))
 
 # 密碼雜湊設定
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
@@ -18,10 +36,57 @@ pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 # JWT Bearer 認證
 security = HTTPBearer()
 
+def hash_refresh_token(token: str) -> str:
+    """refresh token 只以 SHA-256 雜湊儲存（token 本身是高熵隨機值，不需要 bcrypt）"""
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+def successor_refresh_token(token: str) -> str:
+    """
+    由 refresh token 推導出輪替後的新 token（以 SECRET_KEY 做 HMAC）。
+    同一個 token 的新 token 固定不變，寬限期內重複換發可回傳相同的 token，而不必儲存 token 明文。
+    """
+    digest = hmac.new(SECRET_KEY.encode("utf-8"), f"refresh:{token}".encode("utf-8"), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b"=").decode("ascii")
+
+class UserCache:
+    """使用者資料的 TTL 快取（不含密碼雜湊），讓 token 驗證不必每次查詢 MongoDB"""
+
+    def __init__(self, ttl: float = USER_CACHE_TTL_SECONDS, max_size: int = USER_CACHE_MAX_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Tuple[float, Optional[dict]]] = {}
+
+    def get(self, username: str) -> Tuple[bool, Optional[dict]]:
+        """回傳 (是否命中, 使用者資料)；不存在的使用者也會被快取為 None"""
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is None or entry[0] <= time.monotonic():
+                return False, None
+            return True, entry[1]
+
+    def set(self, username: str, user: Optional[dict]):
+        with self._lock:
+            if len(self._entries) >= self.max_size:
+                now = time.monotonic()
+                self._entries = {key: entry for key, entry in self._entries.items() if entry[0] > now}
+                if len(self._entries) >= self.max_size:
+                    self._entries.clear()
+            self._entries[username] = (time.monotonic() + self.ttl, user)
+
 class AuthService:
     def __init__(self, db_client: MongoClient):
         self.db = db_client.internal_system
         self.users_collection = self.db.users
+        self.refresh_tokens = self.db.refresh_tokens
+        self.user_cache = UserCache()
+        self._ensure_indexes()
+
+    def _ensure_indexes(self):
+        """建立 refresh token 所需的索引，過期的 token 由 TTL 索引清除"""
+        self.refresh_tokens.create_index("token_hash", unique=True, name="token_hash")
+        self.refresh_tokens.create_index("family", name="family")
+        self.refresh_tokens.create_index("expires_at", expireAfterSeconds=0, name="expires_at_ttl")
     
     def verify_password(self, plain_password: str, hashed_password: str) -> bool:
         """驗證密碼"""
@@ -40,6 +105,117 @@ class AuthService:
             return None
         return user
     
+    def get_user(self, username: str) -> Optional[dict]:
+        """取得使用者資料（不含密碼雜湊），優先使用快取"""
+        hit, user = self.user_cache.get(username)
+        if hit:
+            return user
+        user = self.users_collection.find_one({"username": username}, {"hashed_password": 0})
+        self.user_cache.set(username, user)
+        return user
+
+    def get_users(self, usernames: Iterable[str]) -> Dict[str, Optional[dict]]:
+        """批次取得多位使用者的資料：快取未命中的使用者以一次 $in 查詢取得，不存在的使用者為 None"""
+        users = {}
+        missing = []
+        for username in set(usernames):
+            hit, user = self.user_cache.get(username)
+            if hit:
+                users[username] = user
+            else:
+                missing.append(username)
+        if missing:
+            found = {
+                user["username"]: user
+                for user in self.users_collection.find({"username": {"$in": missing}}, {"hashed_password": 0})
+            }
+            for username in missing:
+                users[username] = found.get(username)
+                self.user_cache.set(username, users[username])
+        return users
+
+    def create_refresh_token(self, username: str, family: Optional[str] = None, token: Optional[str] = None) -> str:
+        """
+        建立 refresh token（未指定 token 時隨機產生）。同一次登入後輪替出來的 token 屬於同一個 family，
+        偵測到重複使用時整個 family 一起撤銷。同一個 token 重複建立時不會覆寫既有記錄。
+        """
+        token = token or secrets.token_urlsafe(32)
+        now = datetime.utcnow()
+        try:
+            self.refresh_tokens.update_one(
+                {"token_hash": hash_refresh_token(token)},
+                {"$setOnInsert": {
+                    "username": username,
+                    "family": family or uuid.uuid4().hex,
+                    "used": False,
+                    "created_at": now,
+                    "expires_at": now + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
+                }},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            # 另一個請求同時建立了相同的 token
+            pass
+        return token
+
+    def rotate_refresh_token(self, token: str) -> Optional[Tuple[str, str]]:
+        """
+        以 refresh token 換發新的 refresh token，回傳 (使用者名稱, 新 token)。
+        舊 token 只能使用一次；REFRESH_TOKEN_REUSE_GRACE_SECONDS 內再次使用（例如兩個分頁同時換發）
+        回傳同一個新 token，超過寬限期後再次出現代表可能外洩，撤銷整個 family。
+        """
+        token_hash = hash_refresh_token(token)
+        now = datetime.utcnow()
+        record = self.refresh_tokens.find_one_and_update(
+            {"token_hash": token_hash, "used": False, "expires_at": {"$gt": now}},
+            {"$set": {"used": True, "used_at": now}},
+            return_document=ReturnDocument.AFTER
+        )
+        if record is None:
+            reused = self.refresh_tokens.find_one({"token_hash": token_hash, "used": True})
+            if reused is None:
+                return None
+            if reused["used_at"] > now - timedelta(seconds=REFRESH_TOKEN_REUSE_GRACE_SECONDS):
+                return self._grace_successor(reused, token, now)
+            logger.warning(f"Refresh token reuse detected for user {reused['username']}, revoking token family")
+            self.refresh_tokens.delete_many({"family": reused["family"]})
+            return None
+
+        # 使用者已被刪除時不再換發
+        if self.get_user(record["username"]) is None:
+            self.refresh_tokens.delete_many({"family": record["family"]})
+            return None
+        successor = self.create_refresh_token(
+            record["username"], family=record["family"], token=successor_refresh_token(token)
+        )
+        return record["username"], successor
+
+    def _grace_successor(self, record: dict, token: str, now: datetime) -> Optional[Tuple[str, str]]:
+        """
+        寬限期內重複換發：回傳第一次換發時產生的新 token。
+        第一次換發可能尚未寫入新 token，因此在此建立（相同 token 不會重複建立）；
+        新 token 已被使用時拒絕，但不撤銷 family。
+        """
+        if self.get_user(record["username"]) is None:
+            return None
+        successor = self.create_refresh_token(
+            record["username"], family=record["family"], token=successor_refresh_token(token)
+        )
+        current = self.refresh_tokens.find_one({
+            "token_hash": hash_refresh_token(successor), "used": False, "expires_at": {"$gt": now}
+        })
+        if current is None:
+            return None
+        return record["username"], successor
+
+    def revoke_refresh_token(self, token: str) -> bool:
+        """登出：撤銷 refresh token 所屬的整個 family"""
+        record = self.refresh_tokens.find_one({"token_hash": hash_refresh_token(token)})
+        if record is None:
+            return False
+        self.refresh_tokens.delete_many({"family": record["family"]})
+        return True
+
     def create_access_token(self, data: dict, expires_delta: Optional[timedelta] = None):
         """建立 JWT token"""
         to_encode = data.copy()
@@ -58,9 +234,12 @@ class AuthService:
             username: str = payload.get("sub")
             if username is None:
                 return None
-            return {"username": username}
         except JWTError:
             return None
+        # 使用者已被刪除時 token 失效（經由快取，最多延遲 USER_CACHE_TTL_SECONDS）
+        if self.get_user(username) is None:
+            return None
+        return {"username": username, "exp": payload.get("exp")}
 
 # 全域認證服務實例
 _auth_service = None
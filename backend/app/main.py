@@ -1,15 +1,30 @@
-from fastapi import FastAPI, HTTPException, Depends
+# 最先載入，以量測其餘模組的載入時間
+from .services.startup import startup_report
+from fastapi import FastAPI, HTTPException, Depends, Request, Response, BackgroundTasks, WebSocket
 from fastapi.middleware.cors import CORSMiddleware
-from typing import Optional
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse
+from typing import Optional, Union
+import asyncio
 import logging
-from .services.llm import get_llm
-from .services.database import db_service
-from .auth import AuthService, get_current_user, set_auth_service
+from .services.chat import run_chat_turn
+from .services.llm import LLM_MODULES
+from .services.metrics import llm_metrics
+from .services.generation import GenerationInProgressError, generation_registry
+from .services.database import db_service, encode_cursor, parse_cursor
+from .services.compaction import compaction_service, COMPACTION_INTERVAL_SECONDS
+from .services.websocket import connection_manager
+from .services.rate_limit import login_rate_limiter, trusted_proxies, MongoRateLimitStore, LOGIN_RATE_LIMIT_STORE
+from .auth import AuthService, ACCESS_TOKEN_EXPIRE_MINUTES, get_current_user, set_auth_service
 from .models import (
-    LoginRequest, LoginResponse, UserResponse,
-    ChatRequest, ChatResponse, ChatHistoryItem, ChatHistoryResponse, SessionsResponse
+    LoginRequest, LoginResponse, RefreshTokenRequest, UserResponse,
+    ChatRequest, ChatResponse, ChatHistoryItem, ChatHistoryResponse, SessionsResponse,
+    CompactChatHistoryItem, CompactChatHistoryResponse, CompactionResponse,
+    ChatCancelRequest, ChatCancelResponse, UsageDay, UsageTotals, UsageResponse
 )
-from datetime import timedelta
+from datetime import datetime, timedelta
+import hashlib
+import math
 import os
 
 # 設置日誌
@@ -17,7 +32,11 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # Create FastAPI app instance
-app = FastAPI()
+# 使用 orjson 序列化所有回應，比標準 json 快且輸出更精簡
+app = FastAPI(default_response_class=ORJSONResponse)
+
+# 壓縮較大的回應（例如聊天歷史），小於門檻的回應不壓縮
+app.add_middleware(GZipMiddleware, minimum_size=int(os.getenv("GZIP_MINIMUM_SIZE", "1000")))
 
 # 加入 CORS 中間件
 app.add_middleware(
@@ -26,6 +45,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag"],
 )
 
 # 全域認證服務實例
@@ -35,9 +55,16 @@ auth_service = None
 @app.on_event("startup")
 async def startup_event():
     """應用啟動時連接資料庫"""
+    # WebSocket 心跳：每個 worker 只有一個 task 檢查所有連線
+    app.state.heartbeat_task = asyncio.create_task(connection_manager.run_heartbeat())
+
+    # 在背景執行緒預先載入 LLM 相依套件，與資料庫連線同時進行，不延遲就緒時間
+    app.state.warmup_task = asyncio.create_task(asyncio.to_thread(startup_report.warm_up, LLM_MODULES))
+
     try:
         logger.info("Connecting to database...")
-        db_service.connect()
+        with startup_report.step("database"):
+            await asyncio.to_thread(db_service.connect)
         logger.info("Database connected successfully")
         
         # 初始化認證服務
@@ -45,10 +72,24 @@ async def startup_event():
         auth_service = AuthService(db_service.client)
         set_auth_service(auth_service)
         logger.info("Auth service initialized")
+
+        # 多個 worker 共用登入限流狀態
+        if LOGIN_RATE_LIMIT_STORE == "mongo":
+            login_rate_limiter.store = MongoRateLimitStore(db_service.client.internal_system.login_attempts)
+            logger.info("Login rate limiter using shared MongoDB store")
+        
+        # 背景定期壓縮長會話
+        if COMPACTION_INTERVAL_SECONDS > 0:
+            app.state.compaction_task = asyncio.create_task(compaction_service.run_periodically())
+            logger.info("Compaction job started")
     except Exception as e:
         logger.error(f"Failed to connect to database: {e}")
         # 不拋出異常，讓應用繼續運行
 
+    startup_report.mark_ready()
+    report = startup_report.snapshot()
+    logger.info(f"Startup complete: imports {report['import_ms']} ms, ready after {report['time_to_ready_ms']} ms")
+
 # 關閉時斷開資料庫連接
 @app.on_event("shutdown")
 async def shutdown_event():
@@ -60,34 +101,83 @@ async def shutdown_event():
         logger.error(f"Error disconnecting from database: {e}")
 
 # 認證路由
+def _client_ip(request: Request) -> str:
+    """客戶端 IP；只有連線來自 TRUSTED_PROXIES 中的代理時才採用 X-Real-IP"""
+    peer = request.client.host if request.client else None
+    if request.headers.get("x-real-ip") and trusted_proxies.is_trusted(peer):
+        return request.headers["x-real-ip"]
+    return peer or "unknown"
+
 @app.post("/auth/login", response_model=LoginResponse)
-async def login(request: LoginRequest):
+async def login(request: LoginRequest, http_request: Request):
     """使用者登入"""
-    try:
-        if auth_service is None:
-            raise HTTPException(status_code=500, detail="Auth service not initialized")
-            
-        user = auth_service.authenticate_user(request.username, request.password)
-        if not user:
-            raise HTTPException(
-                status_code=401,
-                detail="Incorrect username or password"
-            )
-        
-        access_token_expires = timedelta(minutes=30)
-        access_token = auth_service.create_access_token(
-            data={"sub": user["username"]}, expires_delta=access_token_expires
-        )
-        
-        return LoginResponse(
-            access_token=access_token,
-            token_type="bearer",
-            username=user["username"]
+    if auth_service is None:
+        raise HTTPException(status_code=500, detail="Auth service not initialized")
+
+    # 在驗證密碼前先檢查限流，被拒絕的請求不會執行 bcrypt
+    client_ip = _client_ip(http_request)
+    retry_after = login_rate_limiter.check(client_ip, request.username)
+    if retry_after is not None:
+        logger.warning(f"Login rate limited for {request.username} from {client_ip}")
+        raise HTTPException(
+            status_code=429,
+            detail="Too many login attempts, please try again later",
+            headers={"Retry-After": str(math.ceil(retry_after))}
         )
+
+    try:
+        # bcrypt 驗證很耗 CPU，在執行緒中進行以免阻塞事件迴圈
+        user = await asyncio.to_thread(auth_service.authenticate_user, request.username, request.password)
     except Exception as e:
         logger.error(f"Login error: {e}")
         raise HTTPException(status_code=500, detail="Login failed")
 
+    if not user:
+        login_rate_limiter.record_failure(client_ip, request.username)
+        raise HTTPException(
+            status_code=401,
+            detail="Incorrect username or password"
+        )
+    login_rate_limiter.record_success(client_ip, request.username)
+
+    return _issue_tokens(user["username"])
+
+def _issue_tokens(username: str, refresh_token: Optional[str] = None) -> LoginResponse:
+    """簽發 access token；未提供 refresh token 時建立新的 token family"""
+    access_token = auth_service.create_access_token(
+        data={"sub": username}, expires_delta=timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    )
+    return LoginResponse(
+        access_token=access_token,
+        token_type="bearer",
+        username=username,
+        refresh_token=refresh_token or auth_service.create_refresh_token(username)
+    )
+
+@app.post("/auth/refresh", response_model=LoginResponse)
+async def refresh_token(request: RefreshTokenRequest):
+    """以 refresh token 換發新的 access token 與 refresh token（不需驗證密碼）"""
+    if auth_service is None:
+        raise HTTPException(status_code=500, detail="Auth service not initialized")
+
+    rotated = auth_service.rotate_refresh_token(request.refresh_token)
+    if rotated is None:
+        raise HTTPException(
+            status_code=401,
+            detail="Invalid or expired refresh token"
+        )
+    username, new_refresh_token = rotated
+    return _issue_tokens(username, refresh_token=new_refresh_token)
+
+@app.post("/auth/logout")
+async def logout(request: RefreshTokenRequest):
+    """登出：撤銷 refresh token（access token 仍在到期前有效）"""
+    if auth_service is None:
+        raise HTTPException(status_code=500, detail="Auth service not initialized")
+
+    revoked = auth_service.revoke_refresh_token(request.refresh_token)
+    return {"message": "Logged out", "revoked": revoked}
+
 @app.get("/auth/me", response_model=UserResponse)
 async def get_current_user_info(current_user: dict = Depends(get_current_user)):
     """取得當前使用者資訊"""
@@ -95,52 +185,158 @@ async def get_current_user_info(current_user: dict = Depends(get_current_user)):
 
 # 受保護的聊天路由
 @app.post("/chat", response_model=ChatResponse)
-async def chat_endpoint(request: ChatRequest, current_user: dict = Depends(get_current_user)):
+async def chat_endpoint(
+    request: ChatRequest,
+    http_request: Request,
+    background_tasks: BackgroundTasks,
+    current_user: dict = Depends(get_current_user)
+):
     """
     Receives a user message, sends it to the vLLM API, saves to database, and returns the response.
+    Generation is aborted when the client disconnects or /chat/cancel is called;
+    the partial response is then saved and returned with truncated=true.
     """
     try:
         logger.info(f"Received chat request from {current_user['username']}: {request.message[:50]}...")
         
-        llm = get_llm()
-        # Send the message to the LLM and get the response
-        result = llm.invoke(request.message)
-        bot_response = result.content
-        
-        logger.info("LLM response received, saving to database...")
-        
-        # 儲存聊天記錄到資料庫
         session_id = request.session_id or "default"
+        
         try:
-            db_service.save_chat_message(
-                user_message=request.message,
-                bot_response=bot_response,
-                session_id=session_id,
-                username=current_user["username"]
+            result = await run_chat_turn(
+                current_user["username"], session_id, request.message, http_request.is_disconnected
             )
-            logger.info("Chat message saved to database")
-        except Exception as db_error:
-            logger.error(f"Failed to save chat message: {db_error}")
-            # 繼續執行，不因為資料庫錯誤而中斷聊天功能
+        except GenerationInProgressError as e:
+            raise HTTPException(status_code=409, detail=str(e))
         
-        return ChatResponse(response=bot_response, session_id=session_id)
+        if result["saved"]:
+            # 會話過長時於回應後在背景壓縮
+            background_tasks.add_task(compaction_service.maybe_compact, current_user["username"], session_id)
+        
+        return ChatResponse(response=result["response"], session_id=session_id, truncated=result["truncated"])
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error in chat endpoint: {e}")
         # Return HTTP 500 if any error occurs
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.get("/chat/history", response_model=ChatHistoryResponse)
+@app.post("/chat/cancel", response_model=ChatCancelResponse)
+async def cancel_chat(request: ChatCancelRequest, current_user: dict = Depends(get_current_user)):
+    """
+    Cancel the in-flight generation of a session.
+    """
+    session_id = request.session_id or "default"
+    logger.info(f"Cancel requested for session {session_id} by {current_user['username']}")
+    cancelled = generation_registry.cancel(current_user["username"], session_id)
+    return ChatCancelResponse(session_id=session_id, cancelled=cancelled)
+
+@app.websocket("/ws/chat")
+async def chat_websocket(websocket: WebSocket):
+    """
+    Persistent chat connection. The first message must be {"type": "auth", "token": ...};
+    afterwards chat, cancel, history, sessions and delete_session requests are multiplexed
+    over the socket and chat responses are streamed as delta messages.
+    """
+    await connection_manager.serve(websocket)
+
+def _parse_since(since: str) -> tuple:
+    """解析增量同步游標，回傳 (naive UTC 時間, _id)"""
+    try:
+        return parse_cursor(since)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid since cursor: {since}")
+
+def _history_etag(username: str, version: tuple, *params) -> str:
+    """依歷史版本與查詢參數計算 ETag"""
+    latest, count = version
+    raw = "|".join([username, latest.isoformat() if latest else "", str(count)] + [str(p) for p in params])
+    return f'W/"{hashlib.sha1(raw.encode("utf-8")).hexdigest()}"'
+
+@app.get(
+    "/chat/history",
+    response_model=Union[ChatHistoryResponse, CompactChatHistoryResponse],
+    response_model_exclude_none=True
+)
 async def get_chat_history(
+    request: Request,
+    response: Response,
     session_id: Optional[str] = None, 
     limit: int = 50,
+    compact: bool = False,
+    since: Optional[str] = None,
+    include_summary: bool = False,
+    preview: bool = False,
     current_user: dict = Depends(get_current_user)
 ):
     """
     Get chat history for a specific session or all sessions.
+    With compact=true, username and session_id are returned once instead of on every item.
+    With since=<cursor>, only turns after the cursor are returned (oldest first).
+    With include_summary=true (requires session_id), the session's rolling summary is returned
+    together with the turns it does not cover yet.
+    With preview=true, bot_response only holds the first characters of each reply, for list views.
+    Responds 304 Not Modified when If-None-Match matches the current ETag.
     """
     try:
-        logger.info(f"Getting chat history for user {current_user['username']}, session: {session_id}, limit: {limit}")
-        history = db_service.get_chat_history(session_id=session_id, username=current_user["username"], limit=limit)
+        logger.info(f"Getting chat history for user {current_user['username']}, session: {session_id}, limit: {limit}, since: {since}")
+        since_dt, since_id = _parse_since(since) if since else (None, None)
+        
+        # 版本、摘要與內容在同一個 causally consistent session 中依序讀取：
+        # 即使由不同的 secondary 提供，內容也不會比 ETag 代表的版本舊
+        with db_service.start_read_session() as read_session:
+            # 先以索引查出版本資訊，未變更時不讀取訊息內容
+            version = db_service.get_history_version(
+                session_id=session_id, username=current_user["username"], read_session=read_session
+            )
+            summary = None
+            if include_summary and session_id:
+                summary = db_service.get_session_summary(
+                    session_id=session_id, username=current_user["username"], read_session=read_session
+                )
+            # ETag 只代表歷史版本，不含 since：版本未變表示客戶端已擁有全部資料
+            etag = _history_etag(
+                current_user["username"], version, session_id, limit, compact, preview,
+                summary["summarized_until"].isoformat() if summary else None
+            )
+            if request.headers.get("if-none-match") == etag:
+                logger.info("Chat history not modified")
+                return Response(status_code=304, headers={"ETag": etag})
+            response.headers["ETag"] = etag
+            
+            history = db_service.get_chat_history(
+                session_id=session_id, username=current_user["username"], limit=limit, since=since_dt,
+                since_id=since_id, preview=preview, read_session=read_session
+            )
+        if summary:
+            # 已被摘要涵蓋的對話不再回傳
+            history = [item for item in history if item["timestamp"] > summary["summarized_until"]]
+        
+        # 游標為最新一筆的 (timestamp, _id)；沒有新資料時沿用原游標
+        if history:
+            cursor = encode_cursor(history[-1]["timestamp"], history[-1]["_id"])
+        else:
+            cursor = encode_cursor(since_dt, since_id) if since_dt else None
+        
+        if compact:
+            # 指定 session 時每筆的 session_id 都相同，只在跨 session 查詢時保留
+            compact_items = [
+                CompactChatHistoryItem(
+                    user_message=item["user_message"],
+                    bot_response=item["bot_response"],
+                    timestamp=item["timestamp"].isoformat(),
+                    session_id=None if session_id else item["session_id"],
+                    truncated=item.get("truncated", False)
+                )
+                for item in history
+            ]
+            logger.info(f"Retrieved {len(compact_items)} chat history items (compact)")
+            return CompactChatHistoryResponse(
+                username=current_user["username"],
+                session_id=session_id,
+                history=compact_items,
+                cursor=cursor,
+                summary=summary["summary"] if summary else None
+            )
         
         # 轉換為 Pydantic 模型
         history_items = [
@@ -149,13 +345,20 @@ async def get_chat_history(
                 bot_response=item["bot_response"],
                 timestamp=item["timestamp"].isoformat(),
                 session_id=item["session_id"],
-                username=item["username"]
+                username=item["username"],
+                truncated=item.get("truncated", False)
             )
             for item in history
         ]
         
         logger.info(f"Retrieved {len(history_items)} chat history items")
-        return ChatHistoryResponse(history=history_items)
+        return ChatHistoryResponse(
+            history=history_items,
+            cursor=cursor,
+            summary=summary["summary"] if summary else None
+        )
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error getting chat history: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -196,6 +399,99 @@ async def delete_session(session_id: str, current_user: dict = Depends(get_curre
         logger.error(f"Error deleting session {session_id}: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/chat/sessions/{session_id}/compact", response_model=CompactionResponse)
+async def compact_session(session_id: str, current_user: dict = Depends(get_current_user)):
+    """
+    Summarize the older turns of a session into its rolling summary on demand.
+    """
+    try:
+        logger.info(f"Compacting session {session_id} for user {current_user['username']}")
+        result = await asyncio.to_thread(compaction_service.compact_session, current_user["username"], session_id)
+        if result is None:
+            result = db_service.get_session_summary(
+                session_id=session_id, username=current_user["username"], read_your_writes=True
+            )
+        if not result:
+            return CompactionResponse(session_id=session_id)
+        return CompactionResponse(
+            session_id=session_id,
+            summary=result["summary"],
+            summarized_turns=result["summarized_turns"],
+            summarized_until=result["summarized_until"].isoformat()
+        )
+    except Exception as e:
+        logger.error(f"Error compacting session {session_id}: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+def _usage_totals(rows: list) -> dict:
+    """加總用量並計算平均延遲"""
+    totals = {
+        field: sum(row.get(field, 0) for row in rows)
+        for field in ("turns", "truncated_turns", "prompt_tokens", "completion_tokens", "cached_tokens")
+    }
+    latency_total = sum(row.get("latency_ms_total", 0) for row in rows)
+    completed = totals["turns"] - totals["truncated_turns"]
+    totals["avg_latency_ms"] = round(latency_total / completed, 1) if completed else None
+    return totals
+
+@app.get("/usage", response_model=UsageResponse)
+async def get_usage(
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Get the current user's daily token usage (UTC dates, YYYY-MM-DD, inclusive).
+    Reads the pre-aggregated daily rollups; defaults to the last 30 days.
+    """
+    try:
+        today = datetime.utcnow().date()
+        end = end_date or today.isoformat()
+        start = start_date or (today - timedelta(days=29)).isoformat()
+        for value in (start, end):
+            try:
+                datetime.strptime(value, "%Y-%m-%d")
+            except ValueError:
+                raise HTTPException(status_code=400, detail=f"Invalid date: {value}")
+        
+        rows = db_service.get_usage(username=current_user["username"], start_date=start, end_date=end)
+        days = [UsageDay(date=row["date"], **_usage_totals([row])) for row in rows]
+        return UsageResponse(
+            username=current_user["username"],
+            start_date=start,
+            end_date=end,
+            days=days,
+            totals=UsageTotals(**_usage_totals(rows))
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error getting usage: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/metrics/llm")
+def get_llm_metrics():
+    """
+    TTFT, latency and prefix-cache hit rate of this worker's LLM requests.
+    Cache hits are reported by vLLM when it runs with --enable-prompt-tokens-details.
+    """
+    return llm_metrics.snapshot()
+
+@app.get("/metrics/auth")
+def get_auth_metrics():
+    """
+    Login attempts, failures, lockouts and rate-limited rejections seen by this worker.
+    """
+    return login_rate_limiter.snapshot()
+
+@app.get("/health/startup")
+def startup_health():
+    """
+    Cold-start timing of this worker: app import time, per-step startup time,
+    background-warmed modules and time until the worker was ready (ms).
+    """
+    return startup_report.snapshot()
+
 @app.get("/health")
 def health_check():
     """
@@ -207,4 +503,7 @@ def health_check():
         return {"status": "healthy", "database": db_status}
     except Exception as e:
         logger.error(f"Health check failed: {e}")
-        return {"status": "unhealthy", "database": "error", "error": str(e)} 
\ No newline at end of file
+        return {"status": "unhealthy", "database": "error", "error": str(e)}
+
+# 所有路由與相依模組載入完成
+startup_report.mark_imported()
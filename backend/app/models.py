@@ -11,6 +11,11 @@ class LoginResponse(BaseModel):
     access_token: str
     token_type: str
     username: str
+    refresh_token: str
+
+class RefreshTokenRequest(BaseModel):
+    """換發 token 與登出請求模型"""
+    refresh_token: str
 
 class UserResponse(BaseModel):
     """使用者資訊回應模型"""
@@ -30,6 +35,36 @@ class ChatResponse(BaseModel):
     """
     response: str
     session_id: str
+    truncated: bool = False
+
+class ChatCancelRequest(BaseModel):
+    """
+    Request model for chat cancel endpoint.
+    """
+    session_id: Optional[str] = None
+
+class ChatCancelResponse(BaseModel):
+    """
+    Response model for chat cancel endpoint.
+    """
+    session_id: str
+    cancelled: bool
+
+class WebSocketHistoryRequest(BaseModel):
+    """
+    Request model for the history message of the chat WebSocket.
+    """
+    session_id: Optional[str] = None
+    since: Optional[str] = None
+    limit: int = 50
+    include_summary: bool = False
+    preview: bool = False
+
+class WebSocketSessionRequest(BaseModel):
+    """
+    Request model for the delete_session message of the chat WebSocket.
+    """
+    session_id: str
 
 class ChatHistoryItem(BaseModel):
     """
@@ -40,12 +75,74 @@ class ChatHistoryItem(BaseModel):
     timestamp: str
     session_id: str
     username: str
+    truncated: bool = False
 
 class ChatHistoryResponse(BaseModel):
     """
     Response model for chat history endpoint.
+    cursor identifies the newest item (timestamp and id), to be passed back as `since`.
     """
     history: List[ChatHistoryItem]
+    cursor: Optional[str] = None
+    summary: Optional[str] = None
+
+class CompactChatHistoryItem(BaseModel):
+    """
+    Model for chat history item in compact mode.
+    session_id is only set when the history spans multiple sessions.
+    """
+    user_message: str
+    bot_response: str
+    timestamp: str
+    session_id: Optional[str] = None
+    truncated: bool = False
+
+class CompactChatHistoryResponse(BaseModel):
+    """
+    Compact response model for chat history endpoint.
+    Shared fields are hoisted out of the items.
+    """
+    username: str
+    session_id: Optional[str] = None
+    history: List[CompactChatHistoryItem]
+    cursor: Optional[str] = None
+    summary: Optional[str] = None
+
+class CompactionResponse(BaseModel):
+    """
+    Response model for session compaction endpoint.
+    """
+    session_id: str
+    summary: Optional[str] = None
+    summarized_turns: int = 0
+    summarized_until: Optional[str] = None
+
+class UsageTotals(BaseModel):
+    """
+    Aggregated token usage.
+    """
+    turns: int = 0
+    truncated_turns: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cached_tokens: int = 0
+    avg_latency_ms: Optional[float] = None
+
+class UsageDay(UsageTotals):
+    """
+    Token usage of one user on one day (UTC).
+    """
+    date: str
+
+class UsageResponse(BaseModel):
+    """
+    Response model for usage endpoint.
+    """
+    username: str
+    start_date: str
+    end_date: str
+    days: List[UsageDay]
+    totals: UsageTotals
 
 class SessionsResponse(BaseModel):
     """
@@ -0,0 +1,113 @@
+import logging
+import os
+import time
+from typing import Any, Awaitable, Callable, Optional
+from .database import db_service
+from .generation import GenerationInProgressError, generation_registry
+from .llm import build_messages, estimate_tokens, generate, session_affinity_key, trim_history
+
+logger = logging.getLogger(__name__)
+
+# 提示詞中最多帶入的歷史對話數（正常情況下由會話壓縮限制長度）
+PROMPT_MAX_HISTORY_TURNS = int(os.getenv("PROMPT_MAX_HISTORY_TURNS", "100"))
+# 提示詞的估計 token 上限（模型 context 長度減去回應的 max_tokens）；
+# 正常情況下會話壓縮會讓提示詞遠低於此上限，壓縮落後時才捨棄最舊的對話，一次捨棄到 PROMPT_TRIM_TO_TOKENS 以下
+PROMPT_MAX_TOKENS = int(os.getenv("PROMPT_MAX_TOKENS", "6000"))
+PROMPT_TRIM_TO_TOKENS = int(os.getenv("PROMPT_TRIM_TO_TOKENS", "3000"))
+
+def _estimate_truncated_usage(messages: list, partial_response: str, start: float,
+                              first_delta_at: Optional[float]) -> dict:
+    """
+    被取消的生成拿不到 vLLM 回報的用量，但 GPU 已完成 prefill 與部分 decode，
+    因此以提示詞與部分回應估算 token 數並記錄實際經過的時間，標記為 estimated。
+    """
+    return {
+        "prompt_tokens": sum(estimate_tokens(message.content) for message in messages),
+        "completion_tokens": estimate_tokens(partial_response),
+        "cached_tokens": 0,
+        "latency_ms": round((time.perf_counter() - start) * 1000),
+        "ttft_ms": round((first_delta_at - start) * 1000) if first_delta_at is not None else None,
+        "estimated": True
+    }
+
+async def run_chat_turn(username: str, session_id: str, message: str,
+                        is_disconnected: Callable[[], Awaitable[bool]],
+                        on_delta: Optional[Callable[[str], Any]] = None) -> dict:
+    """
+    執行一輪對話：組合提示詞、串流生成、儲存記錄。
+    生成被取消（客戶端斷線或使用者取消）時儲存部分回應並標記 truncated。
+    會話已有進行中的生成時拋出 GenerationInProgressError。
+    回傳 response、truncated 與 saved（是否成功寫入資料庫）。
+    """
+    # 組合提示詞：系統提示 + 滾動摘要 + 未摘要的歷史對話 + 新訊息
+    summary = None
+    history = []
+    try:
+        # 提示詞必須包含上一輪剛寫入的對話，因此從 primary 讀取
+        summary = db_service.get_session_summary(session_id=session_id, username=username, read_your_writes=True)
+        history = db_service.get_chat_history(
+            session_id=session_id, username=username, limit=PROMPT_MAX_HISTORY_TURNS, read_your_writes=True
+        )
+        if summary:
+            history = [item for item in history if item["timestamp"] > summary["summarized_until"]]
+    except Exception as db_error:
+        logger.error(f"Failed to load conversation context: {db_error}")
+    summary_text = summary["summary"] if summary else None
+    trimmed_history = trim_history(history, message, summary_text, PROMPT_MAX_TOKENS, PROMPT_TRIM_TO_TOKENS)
+    if len(trimmed_history) < len(history):
+        logger.info(f"Dropped {len(history) - len(trimmed_history)} oldest turns to fit the prompt budget")
+    messages = build_messages(trimmed_history, message, summary=summary_text)
+
+    # Send the conversation to the LLM and get the response
+    partial = []
+    start = time.perf_counter()
+    first_delta_at = None
+
+    def handle_delta(text: str):
+        nonlocal first_delta_at
+        if first_delta_at is None:
+            first_delta_at = time.perf_counter()
+        partial.append(text)
+        return on_delta(text) if on_delta else None
+
+    task = generation_registry.start(
+        username,
+        session_id,
+        generate(messages, affinity_key=session_affinity_key(username, session_id), on_delta=handle_delta)
+    )
+    if task is None:
+        raise GenerationInProgressError(f"A response is already being generated for session {session_id}")
+
+    result = await generation_registry.wait(task, is_disconnected)
+    truncated = result is None
+    bot_response = "".join(partial) if truncated else result["content"]
+
+    if truncated:
+        logger.info("LLM generation cancelled, saving partial response to database...")
+    else:
+        logger.info("LLM response received, saving to database...")
+
+    # 儲存聊天記錄到資料庫
+    saved = False
+    try:
+        db_service.save_chat_message(
+            user_message=message,
+            bot_response=bot_response,
+            session_id=session_id,
+            username=username,
+            truncated=truncated,
+            usage=_estimate_truncated_usage(messages, bot_response, start, first_delta_at) if truncated else {
+                "prompt_tokens": result["prompt_tokens"],
+                "completion_tokens": result["completion_tokens"],
+                "cached_tokens": result["cached_tokens"],
+                "latency_ms": round(result["latency"] * 1000),
+                "ttft_ms": round(result["ttft"] * 1000) if result["ttft"] is not None else None
+            }
+        )
+        saved = True
+        logger.info("Chat message saved to database")
+    except Exception as db_error:
+        logger.error(f"Failed to save chat message: {db_error}")
+        # 繼續執行，不因為資料庫錯誤而中斷聊天功能
+
+    return {"response": bot_response, "truncated": truncated, "saved": saved}
@@ -0,0 +1,173 @@
+import asyncio
+import logging
+import os
+import threading
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+from .database import DatabaseService, db_service, MONGO_MAX_STALENESS_SECONDS
+from .llm import estimate_tokens, get_llm
+
+logger = logging.getLogger(__name__)
+
+# 壓縮設定：未摘要的對話超過 token 或筆數門檻時壓縮，保留最新的對話直到 token 預算（最多 KEEP_RECENT_TURNS 筆）。
+# 觸發門檻應低於提示詞預算（PROMPT_MAX_TOKENS），讓壓縮在提示詞需要被截斷之前發生
+COMPACTION_TRIGGER_TOKENS = int(os.getenv("COMPACTION_TRIGGER_TOKENS", "4000"))
+COMPACTION_TRIGGER_TURNS = int(os.getenv("COMPACTION_TRIGGER_TURNS", "60"))
+COMPACTION_KEEP_RECENT_TOKENS = int(os.getenv("COMPACTION_KEEP_RECENT_TOKENS", "1500"))
+COMPACTION_KEEP_RECENT_TURNS = int(os.getenv("COMPACTION_KEEP_RECENT_TURNS", "20"))
+COMPACTION_BATCH_TURNS = int(os.getenv("COMPACTION_BATCH_TURNS", "20"))
+COMPACTION_MAX_CHARS_PER_MESSAGE = int(os.getenv("COMPACTION_MAX_CHARS_PER_MESSAGE", "2000"))
+COMPACTION_SUMMARY_MAX_TOKENS = int(os.getenv("COMPACTION_SUMMARY_MAX_TOKENS", "800"))
+# vLLM 排程優先權（數值越大越晚執行）；只有 vLLM 以 --scheduling-policy priority 啟動時才能設定，
+# 否則 vLLM 會拒絕帶有 priority 的請求，因此預設不送出
+COMPACTION_PRIORITY = int(os.environ["COMPACTION_PRIORITY"]) if os.getenv("COMPACTION_PRIORITY") else None
+COMPACTION_INTERVAL_SECONDS = int(os.getenv("COMPACTION_INTERVAL_SECONDS", "600"))
+
+SUMMARY_PROMPT = """You maintain a rolling summary of a conversation between a user and an assistant.
+Update the existing summary with the new turns below. Keep facts, decisions, open questions and user preferences; drop small talk.
+Write the summary in the same language as the conversation and reply with the summary only.
+
+Existing summary:
+{summary}
+
+New turns:
+{turns}"""
+
+class CompactionService:
+    """將長會話的舊對話摘要為滾動摘要"""
+
+    def __init__(self, db: DatabaseService):
+        self.db = db
+        self._running = set()
+        self._lock = threading.Lock()
+
+    def _format_turns(self, turns: List[dict]) -> str:
+        """將對話轉為摘要提示詞中的文字"""
+        lines = []
+        for turn in turns:
+            lines.append(f"User: {turn['user_message'][:COMPACTION_MAX_CHARS_PER_MESSAGE]}")
+            lines.append(f"Assistant: {turn['bot_response'][:COMPACTION_MAX_CHARS_PER_MESSAGE]}")
+        return "\n".join(lines)
+
+    def _summarize(self, summary: str, turns: List[dict]) -> str:
+        """呼叫 LLM 產生新的摘要（低優先權）"""
+        llm = get_llm(streaming=False, max_tokens=COMPACTION_SUMMARY_MAX_TOKENS, priority=COMPACTION_PRIORITY)
+        prompt = SUMMARY_PROMPT.format(summary=summary or "(none)", turns=self._format_turns(turns))
+        return llm.invoke(prompt).content.strip()
+
+    def _recent_turns(self, username: str, session_id: str, limit: int) -> Tuple[Optional[dict], List[dict]]:
+        """回傳會話摘要與最新 limit 筆中尚未被摘要的對話（由舊到新）"""
+        existing = self.db.get_session_summary(session_id=session_id, username=username, read_your_writes=True)
+        turns = self.db.get_chat_history(session_id=session_id, username=username, limit=limit, read_your_writes=True)
+        if existing:
+            turns = [turn for turn in turns if turn["timestamp"] > existing["summarized_until"]]
+        return existing, turns
+
+    @staticmethod
+    def _turn_tokens(turn: dict) -> int:
+        """估計一輪對話的 token 數"""
+        return estimate_tokens(turn["user_message"]) + estimate_tokens(turn["bot_response"])
+
+    def _compaction_boundary(self, recent: List[dict]) -> Optional[datetime]:
+        """
+        從最新的對話往回保留，直到超過 COMPACTION_KEEP_RECENT_TOKENS 或 COMPACTION_KEEP_RECENT_TURNS 筆
+        （至少保留一筆），回傳第一筆不保留的對話時間，即本次摘要的上界；全部保留時回傳 None。
+        """
+        kept = 0
+        tokens = 0
+        for turn in reversed(recent):
+            tokens += self._turn_tokens(turn)
+            if kept and (kept >= COMPACTION_KEEP_RECENT_TURNS or tokens > COMPACTION_KEEP_RECENT_TOKENS):
+                return turn["timestamp"]
+            kept += 1
+        return None
+
+    def needs_compaction(self, username: str, session_id: str) -> bool:
+        """檢查會話未摘要的對話是否超過 token 或筆數門檻"""
+        _, turns = self._recent_turns(username, session_id, COMPACTION_TRIGGER_TURNS)
+        if len(turns) >= COMPACTION_TRIGGER_TURNS:
+            return True
+        return sum(self._turn_tokens(turn) for turn in turns) >= COMPACTION_TRIGGER_TOKENS
+
+    def compact_session(self, username: str, session_id: str) -> Optional[dict]:
+        """
+        摘要會話中除了最新對話（COMPACTION_KEEP_RECENT_TOKENS 以內）以外的未摘要對話。
+        每批摘要完成後立即儲存，失敗時已完成的批次不會遺失。
+        壓縮期間會話被刪除時停止，且不會重新建立已刪除的摘要。
+        回傳最新摘要；會話正在壓縮中或已被刪除時回傳 None。
+        """
+        key = (username, session_id)
+        with self._lock:
+            if key in self._running:
+                return None
+            self._running.add(key)
+
+        try:
+            existing, recent = self._recent_turns(username, session_id, COMPACTION_KEEP_RECENT_TURNS + 1)
+            summary = existing["summary"] if existing else ""
+            summarized_until = existing["summarized_until"] if existing else None
+            until = self._compaction_boundary(recent)
+
+            while until is not None:
+                turns = self.db.get_turns_to_compact(
+                    session_id=session_id,
+                    username=username,
+                    until=until,
+                    after=summarized_until,
+                    limit=COMPACTION_BATCH_TURNS
+                )
+                if not turns:
+                    break
+
+                summary = self._summarize(summary, turns)
+                # 只有第一次摘要會建立摘要文件；之後摘要不存在代表會話已被刪除
+                create = summarized_until is None
+                summarized_until = turns[-1]["timestamp"]
+                saved = self.db.save_session_summary(
+                    session_id=session_id,
+                    username=username,
+                    summary=summary,
+                    summarized_until=summarized_until,
+                    summarized_turns=len(turns),
+                    create=create
+                )
+                if not saved or (create and not self.db.session_exists(session_id=session_id, username=username)):
+                    # 會話在摘要期間被刪除：移除剛建立的摘要，避免同名的新會話帶入已刪除的對話
+                    if saved:
+                        self.db.delete_session_summary(
+                            session_id=session_id, username=username, summarized_until=summarized_until
+                        )
+                    logger.info(f"Session {session_id} of user {username} was deleted during compaction")
+                    return None
+                logger.info(f"Compacted {len(turns)} turns of session {session_id} for user {username}")
+
+            return self.db.get_session_summary(session_id=session_id, username=username, read_your_writes=True)
+        finally:
+            with self._lock:
+                self._running.discard(key)
+
+    def maybe_compact(self, username: str, session_id: str):
+        """超過門檻時壓縮會話，供聊天後的背景任務使用"""
+        try:
+            if self.needs_compaction(username, session_id):
+                self.compact_session(username, session_id)
+        except Exception as e:
+            logger.error(f"Failed to compact session {session_id}: {e}")
+
+    async def run_periodically(self, interval: int = COMPACTION_INTERVAL_SECONDS):
+        """定期檢查最近有活動的會話並壓縮"""
+        last_run = datetime.utcnow() - timedelta(seconds=interval)
+        while True:
+            await asyncio.sleep(interval)
+            started = datetime.utcnow()
+            try:
+                sessions = await asyncio.to_thread(self.db.get_active_sessions, last_run)
+                for session in sessions:
+                    await asyncio.to_thread(self.maybe_compact, session["username"], session["session_id"])
+                # 活動查詢可能由 secondary 提供，回推最大延遲以免漏掉尚未複寫的對話
+                last_run = started - timedelta(seconds=max(MONGO_MAX_STALENESS_SECONDS, 0))
+            except Exception as e:
+                logger.error(f"Periodic compaction failed: {e}")
+
+# 全域壓縮服務實例
+compaction_service = CompactionService(db_service)
@@ -0,0 +1,75 @@
+import asyncio
+import logging
+import os
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 生成期間檢查客戶端是否斷線的間隔（秒）
+DISCONNECT_POLL_SECONDS = float(os.getenv("DISCONNECT_POLL_SECONDS", "0.5"))
+
+class GenerationInProgressError(RuntimeError):
+    """會話已有進行中的生成"""
+
+class GenerationRegistry:
+    """
+    追蹤每個會話進行中的 LLM 生成，以便在客戶端斷線或使用者要求時取消。
+    取消 task 會關閉與 vLLM 的串流連線，vLLM 隨即中止該請求。
+    註冊表存在於單一 worker 內，取消請求必須送達持有該生成的 worker。
+    """
+
+    def __init__(self):
+        self._tasks: Dict[Tuple[str, str], asyncio.Task] = {}
+
+    def start(self, username: str, session_id: str, coro: Awaitable) -> Optional[asyncio.Task]:
+        """開始生成；該會話已有進行中的生成時回傳 None"""
+        key = (username, session_id)
+        existing = self._tasks.get(key)
+        if existing is not None and not existing.done():
+            coro.close()
+            return None
+
+        task = asyncio.ensure_future(coro)
+        self._tasks[key] = task
+        task.add_done_callback(lambda finished: self._remove(key, finished))
+        return task
+
+    def _remove(self, key: Tuple[str, str], task: asyncio.Task):
+        """生成結束後移除"""
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+
+    def cancel(self, username: str, session_id: str) -> bool:
+        """取消會話進行中的生成，回傳是否有生成被取消"""
+        task = self._tasks.get((username, session_id))
+        if task is None or task.done():
+            return False
+        task.cancel()
+        logger.info(f"Cancelled generation of session {session_id} for user {username}")
+        return True
+
+    async def wait(self, task: asyncio.Task, is_disconnected: Callable[[], Awaitable[bool]],
+                   poll_interval: float = DISCONNECT_POLL_SECONDS) -> Optional[dict]:
+        """
+        等待生成完成，期間定期檢查客戶端是否斷線。
+        生成被取消（客戶端斷線或使用者取消）時回傳 None。
+        """
+        try:
+            while True:
+                done, _ = await asyncio.wait({task}, timeout=poll_interval)
+                if done:
+                    break
+                if await is_disconnected():
+                    logger.info("Client disconnected, cancelling generation")
+                    task.cancel()
+                    break
+            return await task
+        except asyncio.CancelledError:
+            if task.cancelled():
+                return None
+            # 等待者本身被取消時一併取消生成
+            task.cancel()
+            raise
+
+# 全域生成註冊表實例
+generation_registry = GenerationRegistry()
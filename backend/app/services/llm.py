@@ -1,22 +1,159 @@
+import hashlib
+import inspect
 import os
-from langchain_openai import ChatOpenAI
+import time
+from functools import lru_cache
+from typing import TYPE_CHECKING, Any, Callable, List, Optional
+from .metrics import llm_metrics
 
-def get_llm():
+if TYPE_CHECKING:
+    from langchain_core.messages import BaseMessage
+
+# LLM 相依套件載入很慢，改在使用時才載入；啟動時由背景執行緒預先載入
+LLM_MODULES = ("langchain_core.messages", "langchain_openai")
+
+DEFAULT_SYSTEM_PROMPT = "You are ChatFlow Agent, a helpful assistant. Answer clearly and concisely."
+
+# vLLM 路由器依此標頭將同一會話導向同一個實例，以重複使用其 prefix cache
+SESSION_AFFINITY_HEADER = os.getenv("LLM_SESSION_AFFINITY_HEADER", "X-Session-Affinity")
+
+def get_llm(streaming: bool = True, max_tokens: int = 2000, priority: Optional[int] = None,
+            affinity_key: Optional[str] = None):
     """
     Create and return a ChatOpenAI-compatible LLM instance configured for vLLM.
     Environment variable VLLM_API_BASE must be set via docker-compose.
+    priority is forwarded to vLLM's priority scheduler (lower values run first). It is only
+    sent when given: vLLM rejects requests carrying a priority unless it runs with
+    --scheduling-policy priority.
+    affinity_key is sent as a routing hint so a session keeps hitting the same replica.
     """
+    from langchain_openai import ChatOpenAI
+
     # Ensure the environment variable is set
     if "VLLM_API_BASE" not in os.environ:
         raise RuntimeError("Environment variable 'VLLM_API_BASE' is not set.")
 
     api_base = os.environ["VLLM_API_BASE"]
 
+    extra_body = {"priority": priority} if priority is not None else None
+    default_headers = {SESSION_AFFINITY_HEADER: affinity_key} if affinity_key else None
+
     return ChatOpenAI(
         model="gemma-3-27b-it",
         openai_api_key="EMPTY",       # Required field for compatibility
         openai_api_base=api_base,
-        streaming=True,
+        streaming=streaming,
+        stream_usage=True,            # 取得 token 用量（含 prefix cache 命中的 token 數）
         temperature=0.7,
-        max_tokens=2000
+        max_tokens=max_tokens,
+        extra_body=extra_body,
+        default_headers=default_headers
     )
+
+@lru_cache(maxsize=1)
+def get_system_prompt() -> str:
+    """
+    Return the deployment's system prompt.
+    LLM_SYSTEM_PROMPT_FILE takes precedence over LLM_SYSTEM_PROMPT.
+    The prompt is read once so every request shares an identical prefix.
+    """
+    prompt_file = os.getenv("LLM_SYSTEM_PROMPT_FILE")
+    if prompt_file:
+        with open(prompt_file, encoding="utf-8") as f:
+            return f.read().strip()
+    return os.getenv("LLM_SYSTEM_PROMPT", DEFAULT_SYSTEM_PROMPT)
+
+def session_affinity_key(username: str, session_id: str) -> str:
+    """產生會話的路由親和性鍵（不外洩使用者名稱）"""
+    return hashlib.sha256(f"{username}:{session_id}".encode("utf-8")).hexdigest()[:32]
+
+def estimate_tokens(text: str) -> int:
+    """
+    粗估文字的 token 數，不需載入 tokenizer：
+    非 ASCII 字元（中日韓文字）約每字一個 token，ASCII 約每 4 個字元一個 token。
+    """
+    non_ascii = sum(1 for char in text if ord(char) > 127)
+    return non_ascii + (len(text) - non_ascii + 3) // 4
+
+def trim_history(history: List[dict], user_message: str, summary: Optional[str],
+                 max_prompt_tokens: int, trim_to_tokens: int) -> List[dict]:
+    """
+    讓提示詞的估計 token 數不超過 max_prompt_tokens，避免長會話超出模型的 context 長度。
+    超出時從最舊的對話開始一次捨棄到 trim_to_tokens 以下，而不是每輪只捨棄一筆：
+    切點由歷史對話依序重演決定，再次超出預算前之後的每一輪都沿用相同的切點，
+    提示詞的前綴因此保持不變，可繼續重複使用 prefix cache。
+    """
+    total = estimate_tokens(get_system_prompt())
+    if summary:
+        total += estimate_tokens(summary)
+    costs = [estimate_tokens(turn["user_message"]) + estimate_tokens(turn["bot_response"]) for turn in history]
+    start = 0
+    for end, cost in enumerate(costs):
+        total += cost
+        if total > max_prompt_tokens:
+            while start <= end and total > trim_to_tokens:
+                total -= costs[start]
+                start += 1
+    # 新訊息本身過長時才需要再多捨棄（只影響本輪）
+    total += estimate_tokens(user_message)
+    while start < len(history) and total > max_prompt_tokens:
+        total -= costs[start]
+        start += 1
+    return history[start:]
+
+def build_messages(history: List[dict], user_message: str, summary: Optional[str] = None) -> List["BaseMessage"]:
+    """
+    Assemble the prompt for a chat turn.
+    The layout is fixed (system prompt, rolling summary, past turns oldest first,
+    new message), so each turn's prompt extends the previous one except when the
+    session is compacted or trim_history moves its cut point.
+    """
+    from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+
+    system_prompt = get_system_prompt()
+    if summary:
+        system_prompt = f"{system_prompt}\n\nSummary of the earlier conversation:\n{summary}"
+
+    messages: List["BaseMessage"] = [SystemMessage(content=system_prompt)]
+    for turn in history:
+        messages.append(HumanMessage(content=turn["user_message"]))
+        messages.append(AIMessage(content=turn["bot_response"]))
+    messages.append(HumanMessage(content=user_message))
+    return messages
+
+async def generate(messages: List["BaseMessage"], affinity_key: Optional[str] = None,
+                   on_delta: Optional[Callable[[str], Any]] = None) -> dict:
+    """
+    串流呼叫 LLM，回傳完整回應並記錄 TTFT 與 prefix cache 指標。
+    on_delta 會收到每段新產生的文字，生成被取消時呼叫端可用來保留部分回應；
+    on_delta 回傳 awaitable 時會等待它完成，讓慢速的接收端對串流形成背壓。
+    """
+    llm = get_llm(affinity_key=affinity_key)
+
+    start = time.perf_counter()
+    ttft = None
+    response = None
+    async for chunk in llm.astream(messages):
+        if chunk.content:
+            if ttft is None:
+                ttft = time.perf_counter() - start
+            if on_delta:
+                pending = on_delta(chunk.content)
+                if inspect.isawaitable(pending):
+                    await pending
+        response = chunk if response is None else response + chunk
+    latency = time.perf_counter() - start
+
+    usage = (response.usage_metadata if response is not None else None) or {}
+    prompt_tokens = usage.get("input_tokens", 0)
+    cached_tokens = (usage.get("input_token_details") or {}).get("cache_read", 0) or 0
+    llm_metrics.record(ttft, latency, prompt_tokens=prompt_tokens, cached_tokens=cached_tokens)
+
+    return {
+        "content": response.content if response is not None else "",
+        "ttft": ttft,
+        "latency": latency,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": usage.get("output_tokens", 0),
+        "cached_tokens": cached_tokens
+    }
@@ -0,0 +1,54 @@
+import threading
+from collections import deque
+from typing import Optional
+
+class LLMMetrics:
+    """記錄 LLM 請求的 TTFT、延遲與 prefix cache 命中率（單一 worker 內）"""
+
+    def __init__(self, window: int = 1000):
+        self._lock = threading.Lock()
+        self._samples = deque(maxlen=window)
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+
+    def record(self, ttft: Optional[float], latency: float, prompt_tokens: int = 0, cached_tokens: int = 0):
+        """記錄一次請求（秒）"""
+        with self._lock:
+            self.requests += 1
+            self.prompt_tokens += prompt_tokens
+            self.cached_tokens += cached_tokens
+            self._samples.append((ttft, latency, cached_tokens > 0))
+
+    @staticmethod
+    def _percentile(values: list, percentile: float) -> Optional[float]:
+        """計算百分位數，轉為毫秒"""
+        if not values:
+            return None
+        values = sorted(values)
+        index = min(len(values) - 1, int(round(percentile / 100 * (len(values) - 1))))
+        return round(values[index] * 1000, 1)
+
+    def snapshot(self) -> dict:
+        """取得目前的統計資料"""
+        with self._lock:
+            samples = list(self._samples)
+            requests, prompt_tokens, cached_tokens = self.requests, self.prompt_tokens, self.cached_tokens
+
+        ttfts = [ttft for ttft, _, _ in samples if ttft is not None]
+        hit_ttfts = [ttft for ttft, _, hit in samples if ttft is not None and hit]
+        miss_ttfts = [ttft for ttft, _, hit in samples if ttft is not None and not hit]
+        latencies = [latency for _, latency, _ in samples]
+        return {
+            "requests": requests,
+            "prompt_tokens": prompt_tokens,
+            "cached_prompt_tokens": cached_tokens,
+            "prefix_cache_hit_rate": round(cached_tokens / prompt_tokens, 4) if prompt_tokens else None,
+            "ttft_ms": {"p50": self._percentile(ttfts, 50), "p95": self._percentile(ttfts, 95)},
+            "ttft_ms_cache_hit": {"p50": self._percentile(hit_ttfts, 50), "p95": self._percentile(hit_ttfts, 95)},
+            "ttft_ms_cache_miss": {"p50": self._percentile(miss_ttfts, 50), "p95": self._percentile(miss_ttfts, 95)},
+            "latency_ms": {"p50": self._percentile(latencies, 50), "p95": self._percentile(latencies, 95)}
+        }
+
+# 全域 LLM 指標實例
+llm_metrics = LLMMetrics()
@@ -0,0 +1,292 @@
+import ipaddress
+import logging
+import os
+import socket
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import Counter, OrderedDict, deque
+from datetime import datetime
+from typing import Deque, Dict, List, Optional, Set, Tuple
+from pymongo import ReturnDocument
+from pymongo.collection import Collection
+
+logger = logging.getLogger(__name__)
+
+# 登入限流設定
+LOGIN_RATE_LIMIT_STORE = os.getenv("LOGIN_RATE_LIMIT_STORE", "memory")  # memory | mongo
+LOGIN_IP_MAX_ATTEMPTS = int(os.getenv("LOGIN_IP_MAX_ATTEMPTS", "20"))
+LOGIN_IP_WINDOW_SECONDS = float(os.getenv("LOGIN_IP_WINDOW_SECONDS", "60"))
+LOGIN_USER_MAX_FAILURES = int(os.getenv("LOGIN_USER_MAX_FAILURES", "5"))
+LOGIN_USER_WINDOW_SECONDS = float(os.getenv("LOGIN_USER_WINDOW_SECONDS", "900"))
+LOGIN_LOCKOUT_SECONDS = float(os.getenv("LOGIN_LOCKOUT_SECONDS", "60"))
+LOGIN_LOCKOUT_MAX_SECONDS = float(os.getenv("LOGIN_LOCKOUT_MAX_SECONDS", "3600"))
+# 同一使用者名稱來自所有 IP 的失敗上限（寬鬆，防止分散式猜測密碼）；超過時暫停該使用者名稱 LOGIN_LOCKOUT_SECONDS 秒，不加倍
+LOGIN_USER_MAX_FAILURES_ALL_IPS = int(os.getenv("LOGIN_USER_MAX_FAILURES_ALL_IPS", "100"))
+
+# 可信任其 X-Real-IP 標頭的反向代理（IP、CIDR 或主機名稱，以逗號分隔）；預設不信任任何代理
+TRUSTED_PROXIES = [entry.strip() for entry in os.getenv("TRUSTED_PROXIES", "").split(",") if entry.strip()]
+TRUSTED_PROXY_RESOLVE_SECONDS = float(os.getenv("TRUSTED_PROXY_RESOLVE_SECONDS", "60"))
+
+class TrustedProxies:
+    """
+    判斷連線來源是否為可信任的反向代理。
+    主機名稱（例如 docker compose 中的 frontend）會定期重新解析，以跟上容器重啟後的 IP 變化。
+    """
+
+    def __init__(self, entries: List[str]):
+        self._networks = []
+        self._hostnames = []
+        for entry in entries:
+            try:
+                self._networks.append(ipaddress.ip_network(entry, strict=False))
+            except ValueError:
+                self._hostnames.append(entry)
+        self._resolved: Set[str] = set()
+        self._resolved_at = float("-inf")
+
+    def _resolve(self) -> Set[str]:
+        """解析主機名稱（結果快取 TRUSTED_PROXY_RESOLVE_SECONDS 秒）"""
+        now = time.monotonic()
+        if self._hostnames and now - self._resolved_at > TRUSTED_PROXY_RESOLVE_SECONDS:
+            resolved = set()
+            for hostname in self._hostnames:
+                try:
+                    resolved.update(socket.gethostbyname_ex(hostname)[2])
+                except OSError as e:
+                    logger.warning(f"Failed to resolve trusted proxy {hostname}: {e}")
+            self._resolved = resolved
+            self._resolved_at = now
+        return self._resolved
+
+    def is_trusted(self, host: Optional[str]) -> bool:
+        """連線來源是否為可信任的代理"""
+        if not host:
+            return False
+        try:
+            address = ipaddress.ip_address(host)
+        except ValueError:
+            return False
+        if any(address in network for network in self._networks):
+            return True
+        return host in self._resolve()
+
+trusted_proxies = TrustedProxies(TRUSTED_PROXIES)
+
+class RateLimitStore(ABC):
+    """
+    限流狀態的儲存介面。
+    hit 記錄一次事件並回傳滑動視窗內的次數；block 記錄鎖定到期時間與累計鎖定次數。
+    時間一律使用 epoch 秒，以便多個 worker 共用同一份狀態。
+    """
+
+    @abstractmethod
+    def hit(self, key: str, now: float, window: float, limit: int) -> int:
+        """記錄一次事件，回傳視窗內的次數（最多只需保留 limit + 1 筆）"""
+
+    @abstractmethod
+    def get_block(self, key: str, now: float) -> Tuple[float, int]:
+        """回傳 (鎖定到期時間, 累計鎖定次數)；沒有記錄時回傳 (0, 0)"""
+
+    @abstractmethod
+    def set_block(self, key: str, until: float, strikes: int, expires_at: float):
+        """設定鎖定；記錄保留到 expires_at，之後累計次數歸零"""
+
+    @abstractmethod
+    def reset(self, *keys: str):
+        """清除事件與鎖定記錄"""
+
+class InMemoryRateLimitStore(RateLimitStore):
+    """
+    單一 worker 內的限流狀態；多個 worker 時每個 worker 各自計數。
+    記錄以 LRU 順序保存，超過 max_keys 時淘汰最久未使用的記錄，
+    大量不同的 IP 或使用者名稱不會讓記憶體或每次檢查的成本無限增長。
+    """
+
+    def __init__(self, max_keys: int = 100000):
+        self._lock = threading.Lock()
+        self._hits: "OrderedDict[str, Deque[float]]" = OrderedDict()
+        self._blocks: "OrderedDict[str, Tuple[float, int, float]]" = OrderedDict()
+        self.max_keys = max_keys
+
+    def hit(self, key: str, now: float, window: float, limit: int) -> int:
+        with self._lock:
+            hits = self._hits.get(key)
+            if hits is None:
+                hits = self._hits[key] = deque(maxlen=limit + 1)
+                while len(self._hits) > self.max_keys:
+                    self._hits.popitem(last=False)
+            else:
+                self._hits.move_to_end(key)
+            hits.append(now)
+            while hits and hits[0] <= now - window:
+                hits.popleft()
+            return len(hits)
+
+    def get_block(self, key: str, now: float) -> Tuple[float, int]:
+        with self._lock:
+            block = self._blocks.get(key)
+            if block is None or block[2] <= now:
+                self._blocks.pop(key, None)
+                return 0.0, 0
+            return block[0], block[1]
+
+    def set_block(self, key: str, until: float, strikes: int, expires_at: float):
+        with self._lock:
+            self._blocks[key] = (until, strikes, expires_at)
+            self._blocks.move_to_end(key)
+            while len(self._blocks) > self.max_keys:
+                self._blocks.popitem(last=False)
+
+    def reset(self, *keys: str):
+        with self._lock:
+            for key in keys:
+                self._hits.pop(key, None)
+                self._blocks.pop(key, None)
+
+class MongoRateLimitStore(RateLimitStore):
+    """存於 MongoDB 的限流狀態，供多個 worker 或多台主機共用；過期記錄由 TTL 索引清除"""
+
+    def __init__(self, collection: Collection):
+        self.collection = collection
+        self.collection.create_index("expires_at", expireAfterSeconds=0, name="expires_at_ttl")
+
+    def hit(self, key: str, now: float, window: float, limit: int) -> int:
+        # 以 pipeline update 原子地加入本次事件並移除視窗外的記錄
+        doc = self.collection.find_one_and_update(
+            {"_id": key},
+            [{"$set": {
+                "hits": {"$slice": [
+                    {"$filter": {
+                        "input": {"$concatArrays": [{"$ifNull": ["$hits", []]}, [now]]},
+                        "as": "t",
+                        "cond": {"$gt": ["$$t", now - window]}
+                    }},
+                    -(limit + 1)
+                ]},
+                "expires_at": datetime.utcfromtimestamp(now + window)
+            }}],
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        return len(doc["hits"])
+
+    def get_block(self, key: str, now: float) -> Tuple[float, int]:
+        doc = self.collection.find_one({"_id": key})
+        if doc is None or doc["expires_at"] <= datetime.utcfromtimestamp(now):
+            return 0.0, 0
+        return doc["blocked_until"], doc["strikes"]
+
+    def set_block(self, key: str, until: float, strikes: int, expires_at: float):
+        self.collection.update_one(
+            {"_id": key},
+            {"$set": {
+                "blocked_until": until,
+                "strikes": strikes,
+                "expires_at": datetime.utcfromtimestamp(expires_at)
+            }},
+            upsert=True
+        )
+
+    def reset(self, *keys: str):
+        self.collection.delete_many({"_id": {"$in": list(keys)}})
+
+class LoginRateLimiter:
+    """
+    登入限流：在驗證密碼（bcrypt）之前就拒絕超量的請求。
+    - 每個 IP 在 LOGIN_IP_WINDOW_SECONDS 內最多 LOGIN_IP_MAX_ATTEMPTS 次登入嘗試
+    - 同一 IP 對同一使用者名稱在 LOGIN_USER_WINDOW_SECONDS 內失敗 LOGIN_USER_MAX_FAILURES 次後鎖定該組合，
+      鎖定時間從 LOGIN_LOCKOUT_SECONDS 起每次加倍，上限 LOGIN_LOCKOUT_MAX_SECONDS；登入成功後重置。
+      鎖定只針對 (IP, 使用者名稱)，其他人無法以錯誤密碼讓帳號擁有者無法登入
+    - 同一使用者名稱來自所有 IP 的失敗達 LOGIN_USER_MAX_FAILURES_ALL_IPS 次時，暫停該使用者名稱 LOGIN_LOCKOUT_SECONDS 秒（不加倍）
+    儲存發生錯誤時放行（fail open），避免限流狀態的問題讓所有人都無法登入。
+    """
+
+    def __init__(self, store: RateLimitStore):
+        self.store = store
+        self._lock = threading.Lock()
+        self._counters: Counter = Counter()
+
+    def _count(self, name: str):
+        with self._lock:
+            self._counters[name] += 1
+
+    def check(self, ip: str, username: str, now: Optional[float] = None) -> Optional[float]:
+        """檢查是否允許本次登入嘗試；拒絕時回傳需等待的秒數"""
+        now = time.time() if now is None else now
+        self._count("attempts")
+        try:
+            for key in (f"lock:{ip}:{username}", f"ulock:{username}"):
+                blocked_until, _ = self.store.get_block(key, now)
+                if blocked_until > now:
+                    self._count("rejected_locked")
+                    return blocked_until - now
+            if self.store.hit(f"ip:{ip}", now, LOGIN_IP_WINDOW_SECONDS, LOGIN_IP_MAX_ATTEMPTS) > LOGIN_IP_MAX_ATTEMPTS:
+                self._count("rejected_ip")
+                return LOGIN_IP_WINDOW_SECONDS
+        except Exception as e:
+            logger.error(f"Rate limit store error: {e}")
+            self._count("store_errors")
+        return None
+
+    def record_failure(self, ip: str, username: str, now: Optional[float] = None):
+        """記錄一次密碼錯誤，失敗次數達上限時鎖定該 (IP, 使用者名稱)，所有 IP 的失敗過多時暫停該使用者名稱"""
+        now = time.time() if now is None else now
+        self._count("failures")
+        try:
+            failures = self.store.hit(
+                f"fail:{ip}:{username}", now, LOGIN_USER_WINDOW_SECONDS, LOGIN_USER_MAX_FAILURES
+            )
+            if failures >= LOGIN_USER_MAX_FAILURES:
+                _, strikes = self.store.get_block(f"lock:{ip}:{username}", now)
+                strikes += 1
+                duration = min(LOGIN_LOCKOUT_SECONDS * 2 ** (strikes - 1), LOGIN_LOCKOUT_MAX_SECONDS)
+                self.store.set_block(
+                    f"lock:{ip}:{username}", now + duration, strikes,
+                    expires_at=now + duration + LOGIN_USER_WINDOW_SECONDS
+                )
+                self.store.reset(f"fail:{ip}:{username}")
+                self._count("lockouts")
+                logger.warning(f"Locked out user {username} from {ip} for {duration:.0f}s after repeated failures")
+
+            all_failures = self.store.hit(
+                f"ufail:{username}", now, LOGIN_USER_WINDOW_SECONDS, LOGIN_USER_MAX_FAILURES_ALL_IPS
+            )
+            if all_failures >= LOGIN_USER_MAX_FAILURES_ALL_IPS:
+                self.store.set_block(
+                    f"ulock:{username}", now + LOGIN_LOCKOUT_SECONDS, 1,
+                    expires_at=now + LOGIN_LOCKOUT_SECONDS
+                )
+                self.store.reset(f"ufail:{username}")
+                self._count("lockouts")
+                logger.warning(f"Paused logins for user {username} for {LOGIN_LOCKOUT_SECONDS:.0f}s after failures from many addresses")
+        except Exception as e:
+            logger.error(f"Rate limit store error: {e}")
+            self._count("store_errors")
+
+    def record_success(self, ip: str, username: str):
+        """登入成功，清除該 (IP, 使用者名稱) 的失敗與鎖定記錄"""
+        self._count("successes")
+        try:
+            self.store.reset(f"fail:{ip}:{username}", f"lock:{ip}:{username}")
+        except Exception as e:
+            logger.error(f"Rate limit store error: {e}")
+            self._count("store_errors")
+
+    def snapshot(self) -> dict:
+        """回傳本 worker 的登入限流統計"""
+        with self._lock:
+            counters = dict(self._counters)
+        return {
+            "store": type(self.store).__name__,
+            "attempts": counters.get("attempts", 0),
+            "successes": counters.get("successes", 0),
+            "failures": counters.get("failures", 0),
+            "rejected_ip": counters.get("rejected_ip", 0),
+            "rejected_locked": counters.get("rejected_locked", 0),
+            "lockouts": counters.get("lockouts", 0),
+            "store_errors": counters.get("store_errors", 0)
+        }
+
+# 全域登入限流實例（LOGIN_RATE_LIMIT_STORE=mongo 時於啟動後改用共用儲存）
+login_rate_limiter = LoginRateLimiter(InMemoryRateLimitStore())
@@ -0,0 +1,71 @@
+import importlib
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, Optional
+
+def _elapsed_ms(start: float, end: Optional[float]) -> Optional[float]:
+    """兩個時間點之間的毫秒數"""
+    return round((end - start) * 1000, 1) if end is not None else None
+
+class StartupReport:
+    """
+    記錄 worker 冷啟動的耗時：app 模組載入、各啟動步驟、背景預先載入的模組，以及到可接受請求為止的時間。
+    時間皆從本模組被載入時起算（app.main 最先載入本模組）。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.imported_at: Optional[float] = None
+        self.ready_at: Optional[float] = None
+        self.steps: Dict[str, float] = {}
+        self.imports: Dict[str, float] = {}
+        self.warmed_up_at: Optional[float] = None
+
+    def mark_imported(self):
+        """app 模組載入完成"""
+        self.imported_at = time.perf_counter()
+
+    def mark_ready(self):
+        """啟動步驟完成，開始接受請求"""
+        self.ready_at = time.perf_counter()
+
+    @contextmanager
+    def step(self, name: str):
+        """量測一個啟動步驟"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.steps[name] = _elapsed_ms(start, time.perf_counter())
+
+    def warm_up(self, modules: Iterable[str]):
+        """
+        依序載入模組並記錄各自耗時（在背景執行緒執行）。
+        已載入的模組耗時接近 0；請求若先用到尚在載入的模組，會由 import lock 等待載入完成。
+        """
+        for module in modules:
+            start = time.perf_counter()
+            importlib.import_module(module)
+            with self._lock:
+                self.imports[module] = _elapsed_ms(start, time.perf_counter())
+        self.warmed_up_at = time.perf_counter()
+
+    def snapshot(self) -> dict:
+        """回傳啟動耗時報告（毫秒）"""
+        with self._lock:
+            steps = dict(self.steps)
+            imports = dict(self.imports)
+        return {
+            "ready": self.ready_at is not None,
+            "import_ms": _elapsed_ms(self.started, self.imported_at),
+            "time_to_ready_ms": _elapsed_ms(self.started, self.ready_at),
+            "warmup_complete_ms": _elapsed_ms(self.started, self.warmed_up_at),
+            "steps": steps,
+            "imports": imports
+        }
+
+# 全域啟動報告實例
+startup_report = StartupReport()
@@ -0,0 +1,382 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Dict, Optional, Set
+import orjson
+from fastapi import HTTPException, WebSocket, WebSocketDisconnect
+from pydantic import ValidationError
+from ..auth import get_auth_service
+from ..models import (
+    ChatCancelRequest, ChatHistoryItem, ChatRequest, WebSocketHistoryRequest, WebSocketSessionRequest
+)
+from .chat import run_chat_turn
+from .compaction import compaction_service
+from .database import db_service, encode_cursor, parse_cursor
+from .generation import GenerationInProgressError, generation_registry
+
+logger = logging.getLogger(__name__)
+
+# WebSocket 設定
+WS_AUTH_TIMEOUT_SECONDS = float(os.getenv("WS_AUTH_TIMEOUT_SECONDS", "10"))
+WS_HEARTBEAT_SECONDS = float(os.getenv("WS_HEARTBEAT_SECONDS", "30"))
+WS_IDLE_TIMEOUT_SECONDS = float(os.getenv("WS_IDLE_TIMEOUT_SECONDS", "90"))
+WS_SEND_TIMEOUT_SECONDS = float(os.getenv("WS_SEND_TIMEOUT_SECONDS", "10"))
+WS_MAX_INFLIGHT = int(os.getenv("WS_MAX_INFLIGHT", "4"))
+
+# 自訂關閉代碼
+CLOSE_UNAUTHORIZED = 4401
+CLOSE_IDLE_TIMEOUT = 4408
+CLOSE_SLOW_CONSUMER = 1013
+
+class ChatConnection:
+    """
+    單一使用者的 WebSocket 連線。
+    閒置連線只佔用接收迴圈本身，不另外建立 task；送出訊息時直接寫入 socket，
+    以鎖與逾時限制同時寫入的訊息，接收端太慢時關閉連線。
+    """
+
+    def __init__(self, websocket: WebSocket, username: str, token_expires_at: Optional[float] = None):
+        self.websocket = websocket
+        self.username = username
+        self.token_expires_at = token_expires_at
+        self.last_seen = time.monotonic()
+        self.closed = False
+        self.tasks: Set[asyncio.Task] = set()
+        self._send_lock = asyncio.Lock()
+
+    async def is_closed(self) -> bool:
+        """供生成期間檢查連線是否已關閉"""
+        return self.closed
+
+    async def send(self, message: dict):
+        """送出訊息；逾時或失敗時關閉連線（不拋出例外）"""
+        if self.closed:
+            return
+        try:
+            await asyncio.wait_for(self._send(orjson.dumps(message).decode("utf-8")), WS_SEND_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            logger.warning(f"WebSocket send timed out for user {self.username}, closing slow connection")
+            await self.close(CLOSE_SLOW_CONSUMER)
+        except Exception:
+            self.closed = True
+
+    async def _send(self, text: str):
+        """依序寫入 socket；等待寫入完成形成背壓"""
+        async with self._send_lock:
+            await self.websocket.send_text(text)
+
+    async def close(self, code: int = 1000):
+        """關閉連線"""
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
+
+class ConnectionManager:
+    """
+    管理 /ws/chat 的連線：每條連線在開始時驗證身分（心跳時重新檢查），之後在同一個 socket 上
+    多工處理聊天（串流回應片段）、取消、歷史與會話查詢，並推播會話更新到同一使用者的其他連線。
+    """
+
+    def __init__(self):
+        self._connections: Dict[str, Set[ChatConnection]] = {}
+        self._background: Set[asyncio.Task] = set()
+
+    def count(self) -> int:
+        """目前的連線數"""
+        return sum(len(connections) for connections in self._connections.values())
+
+    def _spawn(self, coro, tasks: Set[asyncio.Task]) -> asyncio.Task:
+        """建立 task 並在完成後自動移除"""
+        task = asyncio.create_task(coro)
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        return task
+
+    async def _verify(self, message: dict) -> Optional[dict]:
+        """驗證 {"type": "auth", "token": ...} 訊息，成功時回傳 token 內容（username、exp）"""
+        token = message.get("token")
+        if not isinstance(token, str) or not token:
+            return None
+        return await asyncio.to_thread(get_auth_service().verify_token, token)
+
+    async def _authenticate(self, websocket: WebSocket) -> Optional[dict]:
+        """等待第一則 auth 訊息並驗證 token"""
+        try:
+            raw = await asyncio.wait_for(websocket.receive_text(), WS_AUTH_TIMEOUT_SECONDS)
+            message = orjson.loads(raw)
+            if not isinstance(message, dict) or message.get("type") != "auth":
+                return None
+            return await self._verify(message)
+        except (asyncio.TimeoutError, orjson.JSONDecodeError, HTTPException, WebSocketDisconnect):
+            return None
+
+    async def serve(self, websocket: WebSocket):
+        """處理一條 WebSocket 連線直到關閉"""
+        await websocket.accept()
+        payload = await self._authenticate(websocket)
+        if payload is None:
+            try:
+                await websocket.close(code=CLOSE_UNAUTHORIZED)
+            except Exception:
+                pass
+            return
+
+        username = payload["username"]
+        connection = ChatConnection(websocket, username, token_expires_at=payload.get("exp"))
+        self._connections.setdefault(username, set()).add(connection)
+        logger.info(f"WebSocket connected for user {username} ({self.count()} connections)")
+        await connection.send({"type": "auth_ok", "username": username})
+
+        try:
+            while not connection.closed:
+                raw = await websocket.receive_text()
+                connection.last_seen = time.monotonic()
+                try:
+                    message = orjson.loads(raw)
+                except orjson.JSONDecodeError:
+                    await connection.send({"type": "error", "detail": "Invalid JSON"})
+                    continue
+                if not isinstance(message, dict):
+                    await connection.send({"type": "error", "detail": "Message must be a JSON object"})
+                    continue
+                try:
+                    await self._dispatch(connection, message)
+                except Exception as e:
+                    # 單則訊息的錯誤只回覆給該請求，不中斷連線上其他進行中的請求
+                    logger.error(f"Error handling WebSocket message {message.get('type')}: {e}")
+                    await connection.send({"type": "error", "id": message.get("id"), "detail": str(e)})
+        except (WebSocketDisconnect, RuntimeError):
+            pass
+        finally:
+            # 進行中的生成會在下次斷線檢查時取消，並儲存部分回應
+            connection.closed = True
+            connections = self._connections.get(username)
+            if connections is not None:
+                connections.discard(connection)
+                if not connections:
+                    del self._connections[username]
+            logger.info(f"WebSocket disconnected for user {username} ({self.count()} connections)")
+
+    async def _dispatch(self, connection: ChatConnection, message: dict):
+        """依訊息類型分派處理；欄位以與 HTTP 路由相同的 Pydantic 模型驗證，避免任意值進入資料庫查詢"""
+        message_type = message.get("type")
+        request_id = message.get("id")
+
+        try:
+            if message_type == "ping":
+                await connection.send({"type": "pong"})
+            elif message_type == "pong":
+                return
+            elif message_type == "auth":
+                # access token 到期前，客戶端以換發後的新 token 延長連線
+                payload = await self._verify(message)
+                if payload is None or payload["username"] != connection.username:
+                    await connection.close(CLOSE_UNAUTHORIZED)
+                    return
+                connection.token_expires_at = payload.get("exp")
+                await connection.send({"type": "auth_ok", "id": request_id, "username": connection.username})
+            elif message_type == "chat":
+                request = ChatRequest.model_validate(message)
+                if len(connection.tasks) >= WS_MAX_INFLIGHT:
+                    await connection.send({"type": "error", "id": request_id, "detail": "Too many requests in flight"})
+                    return
+                self._spawn(self._chat(connection, request_id, request), connection.tasks)
+            elif message_type == "cancel":
+                request = ChatCancelRequest.model_validate(message)
+                session_id = request.session_id or "default"
+                cancelled = generation_registry.cancel(connection.username, session_id)
+                await connection.send({"type": "cancelled", "id": request_id, "session_id": session_id, "cancelled": cancelled})
+            elif message_type == "history":
+                await self._history(connection, request_id, WebSocketHistoryRequest.model_validate(message))
+            elif message_type == "sessions":
+                sessions = await asyncio.to_thread(db_service.get_all_sessions, username=connection.username)
+                await connection.send({"type": "sessions", "id": request_id, "sessions": sessions})
+            elif message_type == "delete_session":
+                await self._delete_session(connection, request_id, WebSocketSessionRequest.model_validate(message))
+            else:
+                await connection.send({"type": "error", "id": request_id, "detail": f"Unknown message type: {message_type}"})
+        except ValidationError as e:
+            await connection.send({
+                "type": "error",
+                "id": request_id,
+                "detail": e.errors(include_url=False, include_context=False, include_input=False)
+            })
+
+    async def _chat(self, connection: ChatConnection, request_id, request: ChatRequest):
+        """執行一輪對話，將回應片段即時送出"""
+        session_id = request.session_id or "default"
+        if not request.message:
+            await connection.send({"type": "error", "id": request_id, "detail": "Message is required"})
+            return
+
+        def on_delta(content: str):
+            return connection.send({"type": "delta", "id": request_id, "session_id": session_id, "content": content})
+
+        try:
+            result = await run_chat_turn(
+                connection.username, session_id, request.message, connection.is_closed, on_delta=on_delta
+            )
+        except GenerationInProgressError as e:
+            await connection.send({"type": "error", "id": request_id, "session_id": session_id, "detail": str(e)})
+            return
+        except Exception as e:
+            logger.error(f"Error in WebSocket chat: {e}")
+            await connection.send({"type": "error", "id": request_id, "session_id": session_id, "detail": str(e)})
+            return
+
+        await connection.send({
+            "type": "done",
+            "id": request_id,
+            "session_id": session_id,
+            "response": result["response"],
+            "truncated": result["truncated"]
+        })
+        if result["saved"]:
+            # 會話過長時在背景壓縮
+            self._spawn(
+                asyncio.to_thread(compaction_service.maybe_compact, connection.username, session_id),
+                self._background
+            )
+            await self.broadcast(
+                connection.username,
+                {"type": "session_updated", "session_id": session_id},
+                exclude=connection
+            )
+
+    async def _history(self, connection: ChatConnection, request_id, request: WebSocketHistoryRequest):
+        """查詢聊天歷史，可用 since 增量同步"""
+        session_id = request.session_id
+        try:
+            since, since_id = parse_cursor(request.since) if request.since else (None, None)
+        except ValueError:
+            await connection.send({"type": "error", "id": request_id, "detail": f"Invalid since cursor: {request.since}"})
+            return
+
+        summary = None
+        if request.include_summary and session_id:
+            summary = await asyncio.to_thread(
+                db_service.get_session_summary, session_id=session_id, username=connection.username
+            )
+        history = await asyncio.to_thread(
+            db_service.get_chat_history,
+            session_id=session_id,
+            username=connection.username,
+            limit=request.limit,
+            since=since,
+            since_id=since_id,
+            preview=request.preview
+        )
+        if summary:
+            history = [item for item in history if item["timestamp"] > summary["summarized_until"]]
+
+        if history:
+            cursor = encode_cursor(history[-1]["timestamp"], history[-1]["_id"])
+        else:
+            cursor = encode_cursor(since, since_id) if since else None
+        items = [
+            ChatHistoryItem(
+                user_message=item["user_message"],
+                bot_response=item["bot_response"],
+                timestamp=item["timestamp"].isoformat(),
+                session_id=item["session_id"],
+                username=item["username"],
+                truncated=item.get("truncated", False)
+            ).model_dump()
+            for item in history
+        ]
+        await connection.send({
+            "type": "history",
+            "id": request_id,
+            "session_id": session_id,
+            "history": items,
+            "cursor": cursor,
+            "summary": summary["summary"] if summary else None
+        })
+
+    async def _delete_session(self, connection: ChatConnection, request_id, request: WebSocketSessionRequest):
+        """刪除會話並通知同一使用者的其他連線"""
+        session_id = request.session_id
+        if not session_id:
+            await connection.send({"type": "error", "id": request_id, "detail": "Session ID is required"})
+            return
+        deleted = await asyncio.to_thread(db_service.delete_session, session_id=session_id, username=connection.username)
+        await connection.send({"type": "session_deleted", "id": request_id, "session_id": session_id, "deleted": deleted})
+        if deleted:
+            await self.broadcast(
+                connection.username,
+                {"type": "session_deleted", "session_id": session_id, "deleted": True},
+                exclude=connection
+            )
+
+    async def broadcast(self, username: str, message: dict, exclude: ChatConnection = None):
+        """推播訊息到使用者的所有連線"""
+        targets = [conn for conn in self._connections.get(username, ()) if conn is not exclude]
+        if targets:
+            await asyncio.gather(*(conn.send(message) for conn in targets))
+
+    async def _revalidate(self):
+        """
+        重新檢查已驗證的連線，以 4401 關閉 token 已過期或使用者已被刪除的連線，
+        讓撤銷在 WS_HEARTBEAT_SECONDS 加上使用者快取時間內生效。
+        token 到期時間在行程內比對；使用者是否存在以一次批次查詢確認（快取命中時不查詢 MongoDB）。
+        """
+        now = time.time()
+        expired = [
+            conn for connections in list(self._connections.values()) for conn in list(connections)
+            if conn.token_expires_at is not None and conn.token_expires_at <= now
+        ]
+        if expired:
+            logger.info(f"Closing {len(expired)} WebSocket connections with expired tokens")
+            await asyncio.gather(*(conn.close(CLOSE_UNAUTHORIZED) for conn in expired))
+
+        usernames = list(self._connections)
+        if not usernames:
+            return
+        try:
+            users = await asyncio.to_thread(get_auth_service().get_users, usernames)
+        except Exception as e:
+            logger.error(f"Failed to revalidate WebSocket users: {e}")
+            return
+        revoked = [
+            conn for username, user in users.items() if user is None
+            for conn in list(self._connections.get(username, ()))
+        ]
+        if revoked:
+            logger.info(f"Closing {len(revoked)} WebSocket connections of deleted users")
+            await asyncio.gather(*(conn.close(CLOSE_UNAUTHORIZED) for conn in revoked))
+
+    async def run_heartbeat(self, interval: float = WS_HEARTBEAT_SECONDS):
+        """
+        定期檢查所有連線（整個 worker 只有這一個 task）：
+        超過 WS_IDLE_TIMEOUT_SECONDS 沒有任何訊息的連線關閉，安靜超過一個週期的連線送出 ping，
+        token 過期或使用者已被撤銷的連線以 4401 關閉。
+        """
+        while True:
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            to_ping = []
+            to_close = []
+            for connections in list(self._connections.values()):
+                for conn in list(connections):
+                    idle = now - conn.last_seen
+                    if idle > WS_IDLE_TIMEOUT_SECONDS:
+                        to_close.append(conn)
+                    elif idle > interval:
+                        to_ping.append(conn)
+            if to_close:
+                logger.info(f"Closing {len(to_close)} idle WebSocket connections")
+                await asyncio.gather(*(conn.close(CLOSE_IDLE_TIMEOUT) for conn in to_close))
+            if to_ping:
+                await asyncio.gather(*(conn.send({"type": "ping"}) for conn in to_ping))
+            try:
+                await self._revalidate()
+            except Exception as e:
+                logger.error(f"WebSocket revalidation failed: {e}")
+
+# 全域 WebSocket 連線管理實例
+connection_manager = ConnectionManager()
@@ -4,61 +4,28 @@
 使用方式: python create_users.py
 """
 
-import os
 import sys
 from pymongo import MongoClient
-from passlib.context import CryptContext
+from provision_users import get_connection_string, provision_users
 
-# 密碼雜湊設定
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-
-def get_password_hash(password: str) -> str:
-    """產生密碼雜湊"""
-    return pwd_context.hash(password)
+# 預設使用者列表
+DEFAULT_USERS = [
+    {"username": "admin", "password": "admin123"},
+    {"username": "user1", "password": "user123"},
+    {"username": "user2", "password": "user456"}
+]
 
 def create_default_users():
     """建立預設使用者"""
-    # 資料庫連接設定
-    mongo_username = os.getenv("MONGO_INITDB_ROOT_USERNAME", "admin")
-    mongo_password = os.getenv("MONGO_INITDB_ROOT_PASSWORD", "password")
-    mongo_host = os.getenv("MONGO_HOST", "localhost")
-    mongo_port = os.getenv("MONGO_PORT", "27017")
-    
-    # 建立 MongoDB 連接
-    connection_string = f"mongodb://{mongo_username}:{mongo_password}@{mongo_host}:{mongo_port}/"
-    
+    client = None
     try:
-        client = MongoClient(connection_string)
-        db = client.internal_system
-        users_collection = db.users
-        
-        # 預設使用者列表
-        default_users = [
-            {
-                "username": "admin",
-                "hashed_password": get_password_hash("admin123"),
-                "created_at": "2024-01-01T00:00:00Z"
-            },
-            {
-                "username": "user1",
-                "hashed_password": get_password_hash("user123"),
-                "created_at": "2024-01-01T00:00:00Z"
-            },
-            {
-                "username": "user2", 
-                "hashed_password": get_password_hash("user456"),
-                "created_at": "2024-01-01T00:00:00Z"
-            }
-        ]
+        # 建立 MongoDB 連接
+        client = MongoClient(get_connection_string())
+        users_collection = client.internal_system.users
         
-        # 檢查使用者是否已存在
-        for user in default_users:
-            existing_user = users_collection.find_one({"username": user["username"]})
-            if existing_user:
-                print(f"使用者 {user['username']} 已存在，跳過建立")
-            else:
-                users_collection.insert_one(user)
-                print(f"成功建立使用者: {user['username']}")
+        # 已存在的使用者直接跳過，不做密碼雜湊
+        counts = provision_users(users_collection, DEFAULT_USERS)
+        print(f"建立 {counts['created']} 位使用者，跳過 {counts['skipped']} 位已存在的使用者")
         
         print("\n預設使用者帳號:")
         print("admin / admin123")
@@ -70,7 +37,8 @@ def create_default_users():
         print(f"建立使用者時發生錯誤: {e}")
         sys.exit(1)
     finally:
-        client.close()
+        if client:
+            client.close()
 
 if __name__ == "__main__":
     create_default_users() 
\ No newline at end of file
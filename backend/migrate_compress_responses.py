@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+將既有聊天記錄的 bot_response 轉為壓縮儲存格式的遷移腳本
+使用方式: python migrate_compress_responses.py [--batch-size N] [--dry-run]
+
+- 超過 CHAT_RESPONSE_COMPRESS_THRESHOLD 的回應改存為 zlib 壓縮的 bot_response_z
+- 較長的回應加上 bot_response_preview 供列表檢視使用
+- 遷移前後輸出集合大小與歷史查詢延遲的比較
+"""
+
+import argparse
+import sys
+import time
+from pymongo import UpdateOne
+from app.services.database import db_service, encode_bot_response, CHAT_RESPONSE_COMPRESSION
+
+# 量測延遲時抽樣的會話數
+SAMPLE_SESSIONS = 20
+
+def collection_stats() -> dict:
+    """取得聊天記錄集合的大小資訊"""
+    stats = db_service.db.command("collStats", db_service.chat_collection.name)
+    return {
+        "count": stats.get("count", 0),
+        "size": stats.get("size", 0),
+        "avg_obj_size": stats.get("avgObjSize", 0),
+        "storage_size": stats.get("storageSize", 0)
+    }
+
+def sample_sessions() -> list:
+    """抽樣會話，用於量測遷移前後的歷史查詢延遲"""
+    pipeline = [
+        {"$sample": {"size": SAMPLE_SESSIONS * 5}},
+        {"$group": {"_id": {"username": "$username", "session_id": "$session_id"}}},
+        {"$limit": SAMPLE_SESSIONS}
+    ]
+    return [group["_id"] for group in db_service.chat_collection.aggregate(pipeline)]
+
+def measure_history_latency(sessions: list, preview: bool = False) -> float:
+    """量測讀取抽樣會話歷史的平均延遲（毫秒）"""
+    if not sessions:
+        return 0.0
+    start = time.perf_counter()
+    for session in sessions:
+        db_service.get_chat_history(
+            session_id=session["session_id"], username=session["username"], limit=50, preview=preview
+        )
+    return (time.perf_counter() - start) / len(sessions) * 1000
+
+def migrate(batch_size: int, dry_run: bool) -> dict:
+    """分批轉換尚未壓縮的記錄"""
+    converted = compressed = 0
+    last_id = None
+    while True:
+        filter_query = {"bot_response": {"$exists": True}, "bot_response_preview": {"$exists": False}}
+        if last_id is not None:
+            filter_query["_id"] = {"$gt": last_id}
+        batch = list(
+            db_service.chat_collection.find(filter_query, {"bot_response": 1}).sort("_id", 1).limit(batch_size)
+        )
+        if not batch:
+            break
+        last_id = batch[-1]["_id"]
+
+        operations = []
+        for doc in batch:
+            fields = encode_bot_response(doc["bot_response"])
+            if "bot_response" in fields and "bot_response_preview" not in fields:
+                # 短回應維持原樣
+                continue
+            update = {"$set": {key: value for key, value in fields.items() if key != "bot_response"}}
+            if "bot_response_z" in fields:
+                update["$unset"] = {"bot_response": ""}
+                compressed += 1
+            operations.append(UpdateOne({"_id": doc["_id"]}, update))
+
+        if operations and not dry_run:
+            db_service.chat_collection.bulk_write(operations, ordered=False)
+        converted += len(operations)
+        print(f"已處理 {converted} 筆（壓縮 {compressed} 筆）")
+
+    return {"converted": converted, "compressed": compressed}
+
+def main():
+    """主函數"""
+    parser = argparse.ArgumentParser(description="壓縮既有聊天記錄的 bot_response")
+    parser.add_argument("--batch-size", type=int, default=500, help="每批處理的記錄數")
+    parser.add_argument("--dry-run", action="store_true", help="只計算不寫入")
+    args = parser.parse_args()
+
+    if CHAT_RESPONSE_COMPRESSION != "zlib":
+        print("CHAT_RESPONSE_COMPRESSION 未設為 zlib，不需遷移")
+        return
+
+    try:
+        db_service.connect()
+    except Exception as e:
+        print(f"無法連接資料庫: {e}")
+        sys.exit(1)
+
+    try:
+        sessions = sample_sessions()
+        before = collection_stats()
+        before_latency = measure_history_latency(sessions)
+
+        result = migrate(args.batch_size, args.dry_run)
+
+        after = collection_stats()
+        after_latency = measure_history_latency(sessions)
+        preview_latency = measure_history_latency(sessions, preview=True)
+
+        print("\n遷移結果" + ("（dry run）" if args.dry_run else ""))
+        print("=" * 60)
+        print(f"轉換記錄: {result['converted']}，其中壓縮: {result['compressed']}")
+        print(f"{'':<20}{'遷移前':>18}{'遷移後':>18}")
+        print(f"{'資料大小 (bytes)':<20}{before['size']:>18,}{after['size']:>18,}")
+        print(f"{'平均文件 (bytes)':<20}{before['avg_obj_size']:>18,}{after['avg_obj_size']:>18,}")
+        print(f"{'儲存大小 (bytes)':<20}{before['storage_size']:>18,}{after['storage_size']:>18,}")
+        print(f"{'歷史查詢 (ms)':<20}{before_latency:>18.2f}{after_latency:>18.2f}")
+        print(f"{'預覽查詢 (ms)':<20}{'':>18}{preview_latency:>18.2f}")
+        print("=" * 60)
+    finally:
+        db_service.disconnect()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+批次建立/更新使用者帳號的工具
+使用方式: python provision_users.py users.csv [--update-passwords] [--workers N]
+
+輸入檔為 CSV（需有 username、password 欄位）或 JSONL（每行一個 {"username", "password"} 物件）。
+已存在的使用者預設跳過且不做任何雜湊，重複執行既冪等又快速；
+加上 --update-passwords 時會驗證既有密碼，只有密碼變更的使用者才會重新雜湊並更新。
+"""
+
+import argparse
+import csv
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Tuple
+from pymongo import MongoClient, UpdateOne
+from passlib.context import CryptContext
+
+# 密碼雜湊設定
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+# 每次以 $in 查詢既有使用者的數量
+LOOKUP_BATCH_SIZE = 1000
+
+def get_connection_string() -> str:
+    """建立 MongoDB 連接字串（MONGO_URI 優先）"""
+    if os.getenv("MONGO_URI"):
+        return os.getenv("MONGO_URI")
+    mongo_username = os.getenv("MONGO_INITDB_ROOT_USERNAME", "admin")
+    mongo_password = os.getenv("MONGO_INITDB_ROOT_PASSWORD", "password")
+    mongo_host = os.getenv("MONGO_HOST", "localhost")
+    mongo_port = os.getenv("MONGO_PORT", "27017")
+    return f"mongodb://{mongo_username}:{mongo_password}@{mongo_host}:{mongo_port}/"
+
+def _jsonl_rows(f) -> Iterator[Tuple[int, dict]]:
+    """逐行解析 JSONL，回傳 (行號, 物件)；空行略過，不是 JSON 物件的行拋出 ValueError"""
+    for line_number, line in enumerate(f, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Line {line_number}: invalid JSON: {e.msg}")
+        if not isinstance(row, dict):
+            raise ValueError(f"Line {line_number}: expected a JSON object")
+        yield line_number, row
+
+def _csv_rows(f) -> Iterator[Tuple[int, dict]]:
+    """逐列讀取 CSV，回傳 (行號, 欄位)"""
+    reader = csv.DictReader(f)
+    for row in reader:
+        yield reader.line_num, row
+
+def read_users(path: str) -> List[Dict[str, str]]:
+    """從 CSV 或 JSONL 讀取使用者，同名使用者以最後一筆為準；格式錯誤時拋出 ValueError 並指出行號"""
+    users: Dict[str, str] = {}
+    with open(path, encoding="utf-8", newline="") as f:
+        rows = _jsonl_rows(f) if path.endswith((".jsonl", ".ndjson")) else _csv_rows(f)
+        for line_number, row in rows:
+            username = row.get("username")
+            password = row.get("password")
+            if not isinstance(username, str) or not isinstance(password, str) or not username.strip() or not password:
+                raise ValueError(f"Line {line_number}: username and password are required and must be strings")
+            users[username.strip()] = password
+    return [{"username": username, "password": password} for username, password in users.items()]
+
+def _hash_if_changed(job: Tuple[str, str, Optional[str]]) -> Tuple[str, Optional[str]]:
+    """在子程序中執行：密碼與既有雜湊不符（或無既有雜湊）時回傳新雜湊，否則回傳 None"""
+    username, password, existing_hash = job
+    if existing_hash and pwd_context.verify(password, existing_hash):
+        return username, None
+    return username, pwd_context.hash(password)
+
+def provision_users(users_collection, users: List[Dict[str, str]], update_passwords: bool = False,
+                    workers: Optional[int] = None) -> Dict[str, int]:
+    """
+    以程序池平行雜湊密碼，並用單次 bulk_write upsert 寫入。
+    回傳 created / updated / skipped 數量。
+    """
+    users_collection.create_index("username", unique=True, name="username_unique")
+
+    # 批次查詢既有使用者
+    usernames = [user["username"] for user in users]
+    existing: Dict[str, str] = {}
+    for i in range(0, len(usernames), LOOKUP_BATCH_SIZE):
+        cursor = users_collection.find(
+            {"username": {"$in": usernames[i:i + LOOKUP_BATCH_SIZE]}},
+            {"_id": 0, "username": 1, "hashed_password": 1}
+        )
+        for doc in cursor:
+            existing[doc["username"]] = doc.get("hashed_password")
+
+    jobs = []
+    for user in users:
+        if user["username"] in existing:
+            if not update_passwords:
+                continue
+            jobs.append((user["username"], user["password"], existing[user["username"]]))
+        else:
+            jobs.append((user["username"], user["password"], None))
+
+    hashes: List[Tuple[str, Optional[str]]] = []
+    if len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            chunksize = max(1, len(jobs) // ((workers or os.cpu_count() or 1) * 4))
+            hashes = list(executor.map(_hash_if_changed, jobs, chunksize=chunksize))
+    elif jobs:
+        hashes = [_hash_if_changed(jobs[0])]
+
+    now = datetime.utcnow()
+    operations = []
+    for username, hashed_password in hashes:
+        if hashed_password is None:
+            continue
+        if username in existing:
+            update = {"$set": {"hashed_password": hashed_password}}
+        else:
+            # 查詢時不存在的使用者可能已由另一個程序建立，只在實際插入時寫入密碼，不覆寫其密碼
+            update = {"$setOnInsert": {"hashed_password": hashed_password, "created_at": now}}
+        operations.append(UpdateOne({"username": username}, update, upsert=True))
+
+    created = updated = 0
+    if operations:
+        result = users_collection.bulk_write(operations, ordered=False)
+        created = result.upserted_count
+        updated = result.modified_count
+
+    # 密碼變更後撤銷既有的 refresh token，已登入的裝置需以新密碼重新登入
+    changed = [username for username, hashed_password in hashes if hashed_password is not None and username in existing]
+    if changed:
+        users_collection.database.refresh_tokens.delete_many({"username": {"$in": changed}})
+
+    return {"created": created, "updated": updated, "skipped": len(users) - created - updated}
+
+def main():
+    """主函數"""
+    parser = argparse.ArgumentParser(description="批次建立/更新使用者帳號")
+    parser.add_argument("path", help="使用者清單（.csv 或 .jsonl）")
+    parser.add_argument("--update-passwords", action="store_true", help="更新密碼已變更的既有使用者")
+    parser.add_argument("--workers", type=int, default=None, help="雜湊使用的程序數（預設為 CPU 數）")
+    args = parser.parse_args()
+
+    try:
+        users = read_users(args.path)
+    except (OSError, ValueError) as e:
+        print(f"讀取使用者清單時發生錯誤: {e}")
+        sys.exit(1)
+
+    client = MongoClient(get_connection_string())
+    try:
+        counts = provision_users(
+            client.internal_system.users,
+            users,
+            update_passwords=args.update_passwords,
+            workers=args.workers
+        )
+        print(f"共 {len(users)} 位使用者: 建立 {counts['created']}，更新 {counts['updated']}，跳過 {counts['skipped']}")
+    except Exception as e:
+        print(f"建立使用者時發生錯誤: {e}")
+        sys.exit(1)
+    finally:
+        client.close()
+
+if __name__ == "__main__":
+    main()
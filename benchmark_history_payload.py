@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+比較聊天歷史回應的傳輸大小與序列化時間
+- 完整格式 vs 精簡格式 (compact=true)
+- 標準 json vs orjson
+- 未壓縮 vs gzip
+"""
+
+import gzip
+import json
+import random
+import string
+import time
+from datetime import datetime, timedelta
+
+import orjson
+
+TURNS = 50
+RESPONSE_WORDS = 1500  # 約 2000 tokens
+ITERATIONS = 200
+
+def make_history(username="benchmark_user", session_id="session_1700000000000"):
+    """產生模擬的聊天歷史資料"""
+    random.seed(42)
+    words = ["".join(random.choices(string.ascii_lowercase, k=random.randint(2, 9))) for _ in range(2000)]
+    start = datetime(2024, 1, 1, 12, 0, 0)
+    history = []
+    for i in range(TURNS):
+        history.append({
+            "user_message": " ".join(random.choices(words, k=30)),
+            "bot_response": " ".join(random.choices(words, k=RESPONSE_WORDS)),
+            "timestamp": (start + timedelta(minutes=i)).isoformat(),
+            "session_id": session_id,
+            "username": username
+        })
+    return history
+
+def make_compact(history):
+    """將完整格式轉為精簡格式"""
+    return {
+        "username": history[0]["username"],
+        "session_id": history[0]["session_id"],
+        "history": [
+            {
+                "user_message": item["user_message"],
+                "bot_response": item["bot_response"],
+                "timestamp": item["timestamp"]
+            }
+            for item in history
+        ]
+    }
+
+def time_it(func, payload):
+    """回傳平均序列化時間（毫秒）與輸出"""
+    output = func(payload)
+    start = time.perf_counter()
+    for _ in range(ITERATIONS):
+        func(payload)
+    elapsed = (time.perf_counter() - start) / ITERATIONS * 1000
+    return elapsed, output
+
+def main():
+    """主函數"""
+    history = make_history()
+    payloads = {
+        "verbose": {"history": history},
+        "compact": make_compact(history)
+    }
+    encoders = {
+        "json": lambda p: json.dumps(p, ensure_ascii=False, separators=(",", ":")).encode("utf-8"),
+        "orjson": orjson.dumps
+    }
+
+    print(f"📊 聊天歷史回應效能比較 ({TURNS} 筆對話，每筆約 {RESPONSE_WORDS} 字)")
+    print("=" * 72)
+    print(f"{'格式':<10}{'編碼器':<10}{'序列化 (ms)':>14}{'原始大小 (B)':>16}{'gzip 大小 (B)':>16}")
+    print("-" * 72)
+    for shape, payload in payloads.items():
+        for name, encoder in encoders.items():
+            elapsed, body = time_it(encoder, payload)
+            compressed = gzip.compress(body, compresslevel=9)
+            print(f"{shape:<10}{name:<10}{elapsed:>14.3f}{len(body):>16,}{len(compressed):>16,}")
+    print("=" * 72)
+
+if __name__ == "__main__":
+    main()
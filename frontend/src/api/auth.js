@@ -10,35 +10,89 @@ const api = axios.create({
   },
 })
 
-// 請求攔截器 - 自動加入 token
-api.interceptors.request.use(
-  (config) => {
-    const token = localStorage.getItem('token')
-    if (token) {
-      config.headers.Authorization = `Bearer ${token}`
-    }
-    return config
-  },
-  (error) => {
-    return Promise.reject(error)
+// 儲存登入或換發後取得的 token
+export const storeTokens = (data) => {
+  localStorage.setItem('token', data.access_token)
+  localStorage.setItem('refresh_token', data.refresh_token)
+  localStorage.setItem('username', data.username)
+}
+
+// 清除本地儲存並重新導向登入頁面
+const clearSession = () => {
+  localStorage.removeItem('token')
+  localStorage.removeItem('refresh_token')
+  localStorage.removeItem('username')
+  window.location.href = '/login'
+}
+
+// 進行中的換發請求，同時收到多個 401 時只換發一次
+let refreshPromise = null
+
+// 以 refresh token 換發新的 access token（不經過攔截器，避免遞迴）
+const refreshAccessToken = () => {
+  if (!refreshPromise) {
+    const refreshToken = localStorage.getItem('refresh_token')
+    refreshPromise = axios
+      .post(`${API_BASE_URL}/auth/refresh`, { refresh_token: refreshToken })
+      .then((response) => {
+        storeTokens(response.data)
+        return response.data.access_token
+      })
+      .finally(() => {
+        refreshPromise = null
+      })
   }
-)
+  return refreshPromise
+}
 
-// 回應攔截器 - 處理認證錯誤
-api.interceptors.response.use(
-  (response) => {
-    return response
-  },
-  (error) => {
-    if (error.response?.status === 401) {
-      // Token 無效，清除本地儲存並重新導向登入頁面
-      localStorage.removeItem('token')
-      localStorage.removeItem('username')
-      window.location.href = '/login'
+// 為 axios 實例加入認證攔截器：自動帶上 token，收到 401 時換發一次 token 並重試
+export const attachAuthInterceptors = (instance) => {
+  // 請求攔截器 - 自動加入 token
+  instance.interceptors.request.use(
+    (config) => {
+      const token = localStorage.getItem('token')
+      if (token) {
+        config.headers.Authorization = `Bearer ${token}`
+      }
+      return config
+    },
+    (error) => {
+      return Promise.reject(error)
     }
-    return Promise.reject(error)
-  }
-)
+  )
+
+  // 回應攔截器 - 處理認證錯誤
+  instance.interceptors.response.use(
+    (response) => {
+      return response
+    },
+    async (error) => {
+      const config = error.config
+      if (error.response?.status !== 401 || !config || config.url?.startsWith('/auth/login')) {
+        return Promise.reject(error)
+      }
+      if (config._retried || !localStorage.getItem('refresh_token')) {
+        // 換發後仍無效，或沒有 refresh token，需重新登入
+        clearSession()
+        return Promise.reject(error)
+      }
+
+      config._retried = true
+      try {
+        // 其他分頁已換發過 token 時直接使用新的 token
+        const current = localStorage.getItem('token')
+        const token = config.headers.Authorization === `Bearer ${current}` ? await refreshAccessToken() : current
+        config.headers.Authorization = `Bearer ${token}`
+        return instance(config)
+      } catch (refreshError) {
+        clearSession()
+        return Promise.reject(error)
+      }
+    }
+  )
+}
+
+attachAuthInterceptors(api)
 
 // 登入 API
 export const login = async (username, password) => {
@@ -55,11 +109,17 @@ export const getCurrentUser = async () => {
   return response.data
 }
 
-// 登出函數
-export const logout = () => {
-  localStorage.removeItem('token')
-  localStorage.removeItem('username')
-  window.location.href = '/login'
+// 登出函數：撤銷 refresh token 後清除本地儲存
+export const logout = async () => {
+  const refreshToken = localStorage.getItem('refresh_token')
+  if (refreshToken) {
+    try {
+      await axios.post(`${API_BASE_URL}/auth/logout`, { refresh_token: refreshToken })
+    } catch (error) {
+      console.error('Failed to revoke refresh token:', error)
+    }
+  }
+  clearSession()
 }
 
 // 檢查是否已登入
@@ -70,4 +130,4 @@ export const isAuthenticated = () => {
 // 取得儲存的使用者名稱
 export const getStoredUsername = () => {
   return localStorage.getItem('username')
-} 
\ No newline at end of file
+}
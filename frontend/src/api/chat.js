@@ -1,4 +1,5 @@
 import axios from 'axios'
+import { attachAuthInterceptors } from './auth'
 
 const API_BASE_URL = import.meta.env.VITE_API_BASE_URL || '/api'
 
@@ -10,35 +11,8 @@ const api = axios.create({
   },
 })
 
-// 請求攔截器 - 自動加入 token
-api.interceptors.request.use(
-  (config) => {
-    const token = localStorage.getItem('token')
-    if (token) {
-      config.headers.Authorization = `Bearer ${token}`
-    }
-    return config
-  },
-  (error) => {
-    return Promise.reject(error)
-  }
-)
-
-// 回應攔截器 - 處理認證錯誤
-api.interceptors.response.use(
-  (response) => {
-    return response
-  },
-  (error) => {
-    if (error.response?.status === 401) {
-      // Token 無效，清除本地儲存並重新導向登入頁面
-      localStorage.removeItem('token')
-      localStorage.removeItem('username')
-      window.location.href = '/login'
-    }
-    return Promise.reject(error)
-  }
-)
+// 自動加入 token，token 過期時以 refresh token 換發後重試
+attachAuthInterceptors(api)
 
 /**
  * Send a chat message to the backend /chat API.
@@ -55,19 +29,73 @@ export async function sendChat(message, sessionId = null) {
   return res.data
 }
 
+/**
+ * Cancel the in-flight response generation of a session.
+ * The pending sendChat call resolves with the partial response and truncated=true.
+ * @param {string} sessionId - The session whose generation should stop.
+ * @returns {Promise<Object>} - Whether a generation was cancelled.
+ */
+export async function cancelChat(sessionId = null) {
+  const payload = {}
+  if (sessionId) {
+    payload.session_id = sessionId
+  }
+  const res = await api.post('/chat/cancel', payload)
+  return res.data
+}
+
+// 聊天歷史快取：每個會話保存已取得的記錄、同步游標與 ETag
+const historyCache = new Map()
+
 /**
  * Get chat history from the backend.
+ * Previously loaded sessions are synced incrementally: only turns after the
+ * cached cursor are fetched, and a 304 response reuses the cache as-is.
  * @param {string} sessionId - Optional session ID to filter history.
  * @param {number} limit - Maximum number of messages to retrieve.
  * @returns {Promise<Array>} - Array of chat history items.
  */
 export async function getChatHistory(sessionId = null, limit = 50) {
+  const cacheKey = `${sessionId || ''}:${limit}`
+  const cached = historyCache.get(cacheKey)
+
   const params = { limit }
   if (sessionId) {
     params.session_id = sessionId
   }
-  const res = await api.get('/chat/history', { params })
-  return res.data.history
+  const headers = {}
+  if (cached) {
+    if (cached.cursor) {
+      params.since = cached.cursor
+    }
+    if (cached.etag) {
+      headers['If-None-Match'] = cached.etag
+    }
+  }
+
+  const res = await api.get('/chat/history', {
+    params,
+    headers,
+    validateStatus: (status) => (status >= 200 && status < 300) || status === 304,
+  })
+  if (res.status === 304 && cached) {
+    return cached.history
+  }
+
+  const delta = res.data.history
+  if (cached && delta.length >= limit) {
+    // 新增的記錄超過一頁，捨棄快取重新完整載入
+    historyCache.delete(cacheKey)
+    return getChatHistory(sessionId, limit)
+  }
+
+  const history = cached ? [...cached.history, ...delta].slice(-limit) : delta
+  historyCache.set(cacheKey, {
+    history,
+    cursor: res.data.cursor || (cached && cached.cursor) || null,
+    etag: res.headers.etag || null,
+  })
+  return history
 }
 
 /**
@@ -86,6 +114,12 @@ export async function getAllSessions() {
  */
 export async function deleteSession(sessionId) {
   const res = await api.delete(`/chat/sessions/${sessionId}`)
+  for (const key of historyCache.keys()) {
+    // 同時清除該會話與跨會話的快取
+    if (key.startsWith(`${sessionId}:`) || key.startsWith(':')) {
+      historyCache.delete(key)
+    }
+  }
   return res.data
 }
 
@@ -0,0 +1,19 @@
+// 初始化本機三節點 replica set（已初始化時略過）
+try {
+  rs.status();
+} catch (e) {
+  rs.initiate({
+    _id: "rs0",
+    members: [
+      { _id: 0, host: "mongo1:27017", priority: 2 },
+      { _id: 1, host: "mongo2:27017" },
+      { _id: 2, host: "mongo3:27017" }
+    ]
+  });
+}
+
+// 等待 primary 選出
+while (!db.hello().isWritablePrimary) {
+  sleep(500);
+}
+print("Replica set rs0 is ready");
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+測試 replica set 的讀取路由
+- 歷史、會話查詢由 secondary 提供
+- 寫入與 read-your-writes 查詢走 primary
+
+需在 docker-compose.replicaset.yml 的 backend 容器中執行：
+docker compose -f docker-compose.replicaset.yml exec backend python test_read_preference.py
+"""
+
+import time
+from pymongo import MongoClient
+from app.services.database import db_service
+
+TEST_USER = "read_pref_test_user"
+READS = 20
+
+def query_counters() -> dict:
+    """直接連到每個節點，取得 query 與 insert 的累計次數"""
+    counters = {}
+    for host in db_service.client.nodes:
+        with MongoClient(host[0], host[1], directConnection=True) as node:
+            opcounters = node.admin.command("serverStatus")["opcounters"]
+            is_primary = node.admin.command("hello")["isWritablePrimary"]
+            counters[f"{host[0]}:{host[1]}"] = {
+                "primary": is_primary,
+                "query": opcounters["query"],
+                "insert": opcounters["insert"]
+            }
+    return counters
+
+def diff_counters(before: dict, after: dict, field: str) -> dict:
+    """計算每個節點的增量，依 primary / secondary 分組"""
+    result = {"primary": 0, "secondary": 0}
+    for host, counters in after.items():
+        role = "primary" if counters["primary"] else "secondary"
+        result[role] += counters[field] - before[host][field]
+    return result
+
+def test_topology() -> bool:
+    """測試 replica set 拓撲"""
+    print("🔍 測試 replica set 拓撲...")
+    # 等待驅動程式探索所有節點
+    for _ in range(30):
+        if len(db_service.client.secondaries) == 2:
+            break
+        time.sleep(1)
+    nodes = db_service.client.nodes
+    primary = db_service.client.primary
+    secondaries = db_service.client.secondaries
+    print(f"   節點: {sorted(nodes)}")
+    print(f"   primary: {primary}，secondaries: {sorted(secondaries)}")
+    if len(nodes) != 3 or primary is None or len(secondaries) != 2:
+        print("❌ 拓撲不正確，需要一個 primary 與兩個 secondary")
+        return False
+    print("✅ 拓撲正確")
+    return True
+
+def test_writes_and_read_your_writes(session_id: str) -> bool:
+    """測試寫入與 read-your-writes 查詢都走 primary"""
+    print("\n✍️ 測試寫入與 read-your-writes...")
+    before = query_counters()
+    db_service.save_chat_message("hello", "world", session_id=session_id, username=TEST_USER)
+    history = db_service.get_chat_history(session_id=session_id, username=TEST_USER, read_your_writes=True)
+    after = query_counters()
+
+    inserts = diff_counters(before, after, "insert")
+    queries = diff_counters(before, after, "query")
+    print(f"   insert: {inserts}，query: {queries}")
+    if not history or history[-1]["user_message"] != "hello":
+        print("❌ read-your-writes 查詢沒有讀到剛寫入的訊息")
+        return False
+    if inserts["secondary"] != 0 or queries["primary"] < 1:
+        print("❌ 寫入或 read-your-writes 查詢沒有走 primary")
+        return False
+    print("✅ 寫入與 read-your-writes 查詢走 primary")
+    return True
+
+def test_secondary_reads(session_id: str) -> bool:
+    """測試歷史與會話查詢由 secondary 提供"""
+    print("\n📚 測試歷史與會話查詢...")
+    # 等待 secondary 複寫完成
+    time.sleep(2)
+    before = query_counters()
+    for _ in range(READS):
+        db_service.get_chat_history(session_id=session_id, username=TEST_USER)
+    sessions = db_service.get_all_sessions(username=TEST_USER)
+    after = query_counters()
+
+    queries = diff_counters(before, after, "query")
+    print(f"   query: {queries}")
+    if session_id not in sessions:
+        print("❌ secondary 查詢沒有讀到已複寫的會話")
+        return False
+    if queries["secondary"] < READS:
+        print("❌ 歷史查詢沒有由 secondary 提供")
+        return False
+    print("✅ 歷史與會話查詢由 secondary 提供")
+    return True
+
+def main():
+    """主測試函數"""
+    print("🚀 開始測試 replica set 讀取路由...")
+    print("=" * 60)
+
+    db_service.connect()
+    session_id = f"read_pref_session_{int(time.time())}"
+    try:
+        if not test_topology():
+            return
+        if not test_writes_and_read_your_writes(session_id):
+            return
+        if not test_secondary_reads(session_id):
+            return
+        print("\n" + "=" * 60)
+        print("✅ 所有測試完成！讀取路由正常運作！")
+    finally:
+        db_service.delete_session(session_id=session_id, username=TEST_USER)
+        db_service.disconnect()
+
+if __name__ == "__main__":
+    main()
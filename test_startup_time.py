@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+測試後端冷啟動時間
+- 以 python -X importtime 量測 app.main 的載入時間並檢查預算
+- 確認 LLM 相依套件（langchain）不在載入 app.main 時載入
+- 後端執行中時，檢查 /health/startup 回報的就緒時間
+
+在專案根目錄或 backend 容器內執行：
+python test_startup_time.py
+"""
+
+import os
+import subprocess
+import sys
+from pathlib import Path
+import requests
+
+BASE_URL = "http://localhost:8000"
+
+# 預算（毫秒），可用環境變數調整
+IMPORT_BUDGET_MS = float(os.getenv("STARTUP_IMPORT_BUDGET_MS", "1000"))
+READY_BUDGET_MS = float(os.getenv("STARTUP_READY_BUDGET_MS", "3000"))
+RUNS = 3
+
+# 應在背景預先載入、不應拖慢 app.main 載入的模組
+LAZY_MODULES = ("langchain_openai", "langchain_core.messages", "openai")
+
+def backend_dir() -> Path:
+    """後端原始碼目錄（專案根目錄下的 backend/，或容器內的目前目錄）"""
+    candidate = Path(__file__).resolve().parent / "backend"
+    return candidate if (candidate / "app" / "main.py").exists() else Path.cwd()
+
+def measure_import() -> dict:
+    """以 -X importtime 載入 app.main，回傳各模組的累計載入時間（毫秒）"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import app.main"],
+        cwd=backend_dir(), capture_output=True, text=True, check=True
+    )
+    modules = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        modules[name.strip()] = int(cumulative) / 1000
+    return modules
+
+def test_import_time() -> bool:
+    """測試 app.main 的載入時間"""
+    print(f"⏱️ 測試 app.main 載入時間（預算 {IMPORT_BUDGET_MS:.0f} ms，取 {RUNS} 次最佳）...")
+    runs = [measure_import() for _ in range(RUNS)]
+    best = min(runs, key=lambda modules: modules["app.main"])
+    print(f"   app.main: {best['app.main']:.1f} ms")
+    slowest = sorted(
+        ((name, ms) for name, ms in best.items() if name != "app.main" and "." not in name),
+        key=lambda item: item[1], reverse=True
+    )[:5]
+    for name, ms in slowest:
+        print(f"   {name}: {ms:.1f} ms")
+
+    eager = [name for name in LAZY_MODULES if name in best]
+    if eager:
+        print(f"❌ 以下模組在載入 app.main 時就被載入: {eager}")
+        return False
+    if best["app.main"] > IMPORT_BUDGET_MS:
+        print("❌ app.main 載入時間超出預算")
+        return False
+    print("✅ 載入時間在預算內")
+    return True
+
+def test_startup_report() -> bool:
+    """測試執行中後端回報的就緒時間（後端未啟動時略過）"""
+    print(f"\n🚀 測試 /health/startup（就緒預算 {READY_BUDGET_MS:.0f} ms）...")
+    try:
+        report = requests.get(f"{BASE_URL}/health/startup", timeout=5).json()
+    except requests.RequestException as e:
+        print(f"⚠️ 無法連線到後端，略過: {e}")
+        return True
+
+    print(f"   {report}")
+    if not report["ready"]:
+        print("❌ 後端尚未就緒")
+        return False
+    if report["time_to_ready_ms"] > READY_BUDGET_MS:
+        print("❌ 就緒時間超出預算")
+        return False
+    print("✅ 就緒時間在預算內")
+    return True
+
+def main():
+    """主測試函數"""
+    print("🚀 開始測試冷啟動時間...")
+    print("=" * 60)
+
+    if not test_import_time():
+        sys.exit(1)
+    if not test_startup_report():
+        sys.exit(1)
+
+    print("\n" + "=" * 60)
+    print("✅ 所有測試完成！冷啟動時間在預算內！")
+
+if __name__ == "__main__":
+    main()